@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import zstandard
+
+
+# Stores zstd-compressed HARs outside of PostgreSQL, addressed by the SHA-256
+# of their serialised form and sharded into two levels of directories so that
+# no directory grows too large
+class Archive:
+    def __init__(self, path, level=9):
+        self._path = pathlib.Path(path)
+        self._level = level
+
+    @staticmethod
+    def serialise(har):
+        # A canonical serialisation, so that equal HARs share one file
+        return json.dumps(har, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+    def _file(self, digest):
+        return self._path / digest[:2] / digest[2:4] / f"{digest}.json.zst"
+
+    def put(self, har):
+        # Returns the digest, the serialised size and the compressed size
+        data = self.serialise(har)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._file(digest)
+        if path.exists():
+            return digest, len(data), path.stat().st_size
+
+        compressed = zstandard.ZstdCompressor(level=self._level).compress(data)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so that readers never see a
+        # partially written HAR
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return digest, len(data), len(compressed)
+
+    def get_bytes(self, digest):
+        with open(self._file(digest), 'rb') as f:
+            return zstandard.ZstdDecompressor().decompress(f.read())
+
+    def get(self, digest):
+        return json.loads(self.get_bytes(digest))
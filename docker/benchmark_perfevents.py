@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs inside a browser image, where perf is installed and allowed to count
+# system-wide:
+#
+#   docker run --rm --security-opt seccomp=seccomp.json --cap-add SYS_ADMIN \
+#       -v $PWD/benchmark_perfevents.py:/home/seluser/measure/benchmark_perfevents.py \
+#       --entrypoint python3 privacy-extensions-chrome benchmark_perfevents.py
+
+import argparse
+import collections
+import csv
+import io
+import mmap
+import os
+import signal
+import statistics
+import subprocess
+import threading
+import time
+
+import perfevents
+
+
+class PerfEventsCSVDialect(csv.Dialect):
+    delimiter = ' '
+    lineterminator = '\n'
+    quoting = csv.QUOTE_NONE
+    skipinitialspace = True
+
+
+# The collector run.py used before PerfEvents: perf stat record around a
+# sleep that is killed on stop, then perf script to read perf.data back
+class LegacyPerfEvents(threading.Thread):
+    def __init__(self, timeout):
+        self._timeout = timeout
+        threading.Thread.__init__(self)
+
+    def run(self):
+        cmd = ["perf_4.19", "stat", "record",
+               *(arg for event in perfevents.EVENTS for arg in ("-e", event)),
+               "-a", "--", "sleep", f"{self._timeout + 1}"]
+        self.process = subprocess.Popen(cmd,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        self.process.wait()
+
+    def stop(self):
+        # Wait for perf to start sleep, which the old code left to chance
+        pid = None
+        while not pid:
+            run = subprocess.run(["pgrep", "-P", f"{self.process.pid}"],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+            pid = run.stdout.strip().decode('utf-8')
+        os.kill(int(pid), signal.SIGTERM)
+        self.process.wait()
+
+        run = subprocess.run(["perf_4.19", "script"],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+        csv_dict = csv.DictReader(io.StringIO(run.stdout.decode('utf-8')),
+                                  dialect=PerfEventsCSVDialect)
+        perf = collections.defaultdict(int)
+        for row in csv_dict:
+            perf[row['EVENT']] += int(row['VAL'])
+        return perf
+
+
+COLLECTORS = {'record+script': LegacyPerfEvents, 'stat -x': perfevents.PerfEvents}
+
+
+def workload(busy, pages):
+    # A known amount of work: `busy` seconds on one CPU and `pages` page faults
+    deadline = time.perf_counter() + busy
+    while time.perf_counter() < deadline:
+        pass
+    with mmap.mmap(-1, pages * mmap.PAGESIZE) as memory:
+        for page in range(pages):
+            memory[page * mmap.PAGESIZE] = 1
+
+
+def measure(collector, busy, pages):
+    perf = COLLECTORS[collector](30)
+    started = time.perf_counter()
+    perf.start()
+    ready = time.perf_counter()
+    workload(busy, pages)
+    done = time.perf_counter()
+    counts = perf.stop()
+    stopped = time.perf_counter()
+    return {'start': ready - started, 'stop': stopped - done, 'counts': counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the overhead and the counts of the perf collectors "
+                    "around a known workload")
+    parser.add_argument('-r', '--repetitions', type=int, default=10)
+    parser.add_argument('--busy', type=float, default=0.5,
+                        help="seconds of CPU time the workload spends")
+    parser.add_argument('--pages', type=int, default=10000,
+                        help="pages the workload touches")
+    args = parser.parse_args()
+
+    results = {collector: [] for collector in COLLECTORS}
+    for _ in range(args.repetitions):
+        for collector in COLLECTORS:
+            results[collector].append(measure(collector, args.busy, args.pages))
+
+    print(f"{args.repetitions} repetitions, workload of {args.busy * 1000:.0f}ms CPU "
+          f"and {args.pages} page faults")
+    print(f"{'collector':<14} {'median start':>12} {'median stop':>12} {'overhead':>10}")
+    for collector, runs in results.items():
+        start = statistics.median(run['start'] for run in runs)
+        stop = statistics.median(run['stop'] for run in runs)
+        print(f"{collector:<14} {start * 1000:>10.1f}ms {stop * 1000:>10.1f}ms "
+              f"{(start + stop) * 1000:>8.1f}ms")
+
+    # Clocks are in nanoseconds, the system-wide counts include everything
+    # else that ran in the meantime, so they are at least the workload
+    print(f"\n{'event':<18} " + " ".join(f"{collector:>24}" for collector in COLLECTORS))
+    for event in perfevents.EVENTS:
+        cells = []
+        for runs in results.values():
+            values = [run['counts'].get(event) or 0 for run in runs]
+            cells.append(f"{statistics.median(values):>14.0f} ±{statistics.pstdev(values):>8.0f}")
+        print(f"{event:<18} " + " ".join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import pathlib
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from sanitise import sanitise
+
+
+# The code path get_extended_har used before sanitise(): parse, strip content,
+# serialise, strip zero bytes and parse again
+def legacy_sanitise(output):
+    json_har = json.loads(output.decode('utf-8'))
+    for entry in json_har['har']['entries']:
+        if 'text' in entry['response']['content']:
+            del entry['response']['content']['text']
+    har_reassembled = json.dumps(json_har)
+    if "\\u0000" in har_reassembled:
+        har_stripped = re.sub(r"(\\)+u0000", "", har_reassembled)
+        json_har = json.loads(har_stripped)
+    return json_har
+
+
+SANITISERS = {'legacy': legacy_sanitise, 'streaming': sanitise}
+
+
+def measure(sanitiser, path):
+    # Runs in a fresh interpreter so that the peak RSS belongs to one HAR only
+    output = pathlib.Path(path).read_bytes()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    SANITISERS[sanitiser](output)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json.dump({'time': elapsed, 'rss': (peak - baseline) * 1024}, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare time and peak RSS of the HAR sanitisers over a corpus "
+                    "of run.py outputs")
+    parser.add_argument('corpus', help="directory containing run.py outputs (*.json)")
+    parser.add_argument('-r', '--repetitions', type=int, default=3)
+    parser.add_argument('--measure', nargs=2, metavar=('SANITISER', 'FILE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    files = sorted(pathlib.Path(args.corpus).glob("*.json"))
+    if not files:
+        parser.error(f"No *.json files in '{args.corpus}'")
+
+    results = {sanitiser: {'time': [], 'rss': []} for sanitiser in SANITISERS}
+    for path in files:
+        for _ in range(args.repetitions):
+            for sanitiser in SANITISERS:
+                cmd = [sys.executable, __file__, args.corpus,
+                       "--measure", sanitiser, str(path)]
+                run = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+                result = json.loads(run.stdout)
+                results[sanitiser]['time'].append(result['time'])
+                results[sanitiser]['rss'].append(result['rss'])
+
+    size = sum(path.stat().st_size for path in files)
+    print(f"{len(files)} HARs, {size / 2**20:.1f} MiB, {args.repetitions} repetitions")
+    print(f"{'sanitiser':<12} {'median time':>12} {'total time':>12} "
+          f"{'median peak RSS':>16} {'max peak RSS':>14}")
+    for sanitiser, result in results.items():
+        print(f"{sanitiser:<12} "
+              f"{statistics.median(result['time']) * 1000:>10.1f}ms "
+              f"{sum(result['time']) / args.repetitions:>11.2f}s "
+              f"{statistics.median(result['rss']) / 2**20:>13.1f}MiB "
+              f"{max(result['rss']) / 2**20:>11.1f}MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import subprocess
+import threading
+
+log = logging.getLogger('cgroups')
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+CPU_FIELDS = ('usage_usec', 'user_usec', 'system_usec', 'throttled_usec')
+IO_FIELDS = ('rbytes', 'wbytes', 'rios', 'wios')
+
+
+def cgroup_path(container):
+    # The container is given by name or ID. Docker puts containers into these
+    # cgroups with the systemd and the cgroupfs driver respectively, other
+    # layouts are found through the cgroup of the container's init process.
+    run = subprocess.run(["docker", "inspect", "-f", "{{.Id}} {{.State.Pid}}", container],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    fields = run.stdout.decode('utf-8').split()
+    if len(fields) != 2:
+        return None
+    container_id, pid = fields
+    for path in (f"{CGROUP_ROOT}/system.slice/docker-{container_id}.scope",
+                 f"{CGROUP_ROOT}/docker/{container_id}"):
+        if os.path.isdir(path):
+            return path
+
+    if pid == "0":
+        return None
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return CGROUP_ROOT + line[3:].strip()
+    except OSError:
+        pass
+    return None
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _read_keys(path):
+    with open(path) as f:
+        return {key: int(value) for key, value in (line.split() for line in f)}
+
+
+def _read_io(path):
+    # One line of key=value pairs per device. There is no io.stat unless the io
+    # controller is enabled for the cgroup, then the io is unavailable.
+    io = dict.fromkeys(IO_FIELDS, 0)
+    try:
+        with open(path) as f:
+            for line in f:
+                for pair in line.split()[1:]:
+                    key, _, value = pair.partition("=")
+                    if key in io:
+                        io[key] += int(value)
+    except OSError:
+        return None
+    return io
+
+
+def _read_net(path):
+    # The network namespace of the container, as seen by its first process
+    try:
+        with open(f"{path}/cgroup.procs") as f:
+            pid = f.readline().strip()
+        with open(f"/proc/{pid}/net/dev") as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        return None
+
+    net = {'rx_bytes': 0, 'tx_bytes': 0}
+    for line in lines:
+        interface, _, counters = line.partition(":")
+        if interface.strip() == "lo":
+            continue
+        counters = counters.split()
+        net['rx_bytes'] += int(counters[0])
+        net['tx_bytes'] += int(counters[8])
+    return net
+
+
+def read_stats(path):
+    cpu = _read_keys(f"{path}/cpu.stat")
+    return {'cpu': {field: cpu.get(field) for field in CPU_FIELDS},
+            'memory': {'current': _read_int(f"{path}/memory.current"),
+                       'peak': _read_int(f"{path}/memory.peak")},
+            'io': _read_io(f"{path}/io.stat"),
+            'pids': {'current': _read_int(f"{path}/pids.current"),
+                     'peak': _read_int(f"{path}/pids.peak")},
+            'net': _read_net(path)}
+
+
+def _delta(first, last):
+    if first is None or last is None:
+        return last
+    return {key: None if last[key] is None or first[key] is None else last[key] - first[key]
+            for key in last}
+
+
+# Samples the cgroup v2 of a container from the host while it serves a visit.
+# The cgroup of a one-shot container is gone as soon as it exits, so its last
+# sample is kept. One-shot containers only ever serve one visit, so their
+# counters are reported as they are, those of long-lived containers as the
+# difference between the first and last sample of the visit.
+class CgroupMonitor(threading.Thread):
+    def __init__(self, interval=0.1):
+        super().__init__(name='cgroup-monitor', daemon=True)
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._container = None
+        self._cidfile = None
+        self._path = None
+        self._cumulative = True
+        self._first = None
+        self._last = None
+        self._max_memory = None
+        self._max_pids = None
+        self._samples = 0
+
+    def watch(self, container=None, cidfile=None):
+        # Either the name or ID of a running container, whose first sample is
+        # taken right away, or the file that `docker run --cidfile` writes the
+        # ID of a new container to once it is created
+        self._container = container
+        self._cidfile = cidfile
+        self._cumulative = container is None
+        if container:
+            self._path = cgroup_path(container)
+            self._sample()
+        self.start()
+
+    def _find(self):
+        if self._container is None:
+            try:
+                with open(self._cidfile) as f:
+                    self._container = f.read().strip() or None
+            except OSError:
+                return None
+        return cgroup_path(self._container) if self._container else None
+
+    def _sample(self):
+        if self._path is None:
+            self._path = self._find()
+        if self._path is None:
+            return True
+        try:
+            sample = read_stats(self._path)
+        except OSError:
+            # The container exited
+            return False
+
+        if self._first is None:
+            self._first = sample
+        self._last = sample
+        self._samples += 1
+        memory, pids = sample['memory']['current'], sample['pids']['current']
+        if memory is not None:
+            self._max_memory = max(memory, self._max_memory or 0)
+        if pids is not None:
+            self._max_pids = max(pids, self._max_pids or 0)
+        return True
+
+    def run(self):
+        while True:
+            stopped = self._stopped.is_set()
+            if not self._sample() or stopped:
+                break
+            self._stopped.wait(self._interval)
+
+    def stop(self):
+        if self.is_alive():
+            self._stopped.set()
+            self.join()
+        if self._last is None:
+            log.warning(f"No cgroup found for container '{self._container or self._cidfile}'")
+        return self.stats()
+
+    def stats(self):
+        if self._last is None:
+            return None
+
+        first = None if self._cumulative else self._first
+        memory_peak = self._last['memory']['peak'] if self._cumulative else None
+        pids_peak = self._last['pids']['peak'] if self._cumulative else None
+        return {'cpu': _delta(first and first['cpu'], self._last['cpu']),
+                'memory': {'peak': memory_peak or self._max_memory},
+                'io': _delta(first and first['io'], self._last['io']),
+                'pids': {'peak': pids_peak or self._max_pids},
+                'net': _delta(first and first['net'], self._last['net']),
+                'samples': self._samples}
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+
+from selenium.common.exceptions import WebDriverException
+
+log = logging.getLogger('completion')
+
+# The times since navigation started, in milliseconds, of the end of the load
+# event and of the last response that finished, and the number of fetch and
+# XMLHttpRequest requests in flight, or nothing before the navigation. Those
+# requests are only counted from the first poll on, and only if the page calls
+# the functions that the script wraps. Other requests in flight, like images,
+# are not seen until they finish.
+STATE_SCRIPT = """
+    if (location.protocol === 'about:') {
+        return null;
+    }
+    if (!window.__inFlight) {
+        performance.setResourceTimingBufferSize(100000);
+        var inFlight = window.__inFlight = {count: 0};
+        var finished = function() { inFlight.count--; };
+        if (window.fetch) {
+            var fetch = window.fetch;
+            window.fetch = function() {
+                inFlight.count++;
+                return fetch.apply(this, arguments).finally(finished);
+            };
+        }
+        var send = XMLHttpRequest.prototype.send;
+        XMLHttpRequest.prototype.send = function() {
+            inFlight.count++;
+            this.addEventListener('loadend', finished);
+            try {
+                return send.apply(this, arguments);
+            } catch (e) {
+                this.removeEventListener('loadend', finished);
+                finished();
+                throw e;
+            }
+        };
+    }
+    var navigation = performance.getEntriesByType('navigation')[0];
+    var lastResponse = performance.getEntriesByType('resource').reduce(function(last, entry) {
+        return Math.max(last, entry.responseEnd);
+    }, navigation ? navigation.responseEnd : 0);
+    return {now: performance.now(),
+            loadEnd: navigation ? navigation.loadEventEnd : 0,
+            lastResponse: lastResponse,
+            inFlight: window.__inFlight.count};
+"""
+
+# The network counts as idle with at most this many requests in flight, so
+# that long polls do not keep it busy
+MAX_IN_FLIGHT = 2
+
+# The version of harexporttrigger that the completion policy uses exports the
+# HAR when its content script sees this event, with what it has so far
+EXPORT_SCRIPT = "document.dispatchEvent(new CustomEvent('HAR.triggerExport'));"
+
+
+# Decides when a visit is complete. By default, that is when the page fires
+# its load event and harexporttrigger exports the HAR. With an idle time or a
+# cap, in milliseconds, the export is forced instead: once the load event is
+# over and no response has finished since for the idle time, with at most
+# MAX_IN_FLIGHT requests in flight, or right after the load event without an
+# idle time. The cap, counted from the start of the navigation, ends the visit
+# at the latest, whether the page loaded or not. The browser then has to be
+# told not to wait for the load event itself.
+class CompletionPolicy:
+    def __init__(self, idle=None, cap=None):
+        self.idle = idle
+        self.cap = cap
+        self.ended_by = None
+        self.ended_at = None
+
+    @property
+    def waits_for_load(self):
+        return self.idle is None and self.cap is None
+
+    def _state(self, driver):
+        try:
+            return driver.execute_script(STATE_SCRIPT)
+        except WebDriverException:
+            # The document is being replaced
+            return None
+
+    def poll(self, driver):
+        # Called while waiting for the HAR, returns whether the export was
+        # forced just now
+        if self.waits_for_load or self.ended_by:
+            return False
+
+        state = self._state(driver)
+        if not state:
+            return False
+        if state['loadEnd']:
+            idle = state['now'] - max(state['lastResponse'], state['loadEnd'])
+            if self.idle is None:
+                self.ended_by = "load"
+            elif idle >= self.idle and state['inFlight'] <= MAX_IN_FLIGHT:
+                self.ended_by = "idle"
+        if self.ended_by is None and self.cap is not None and state['now'] >= self.cap:
+            self.ended_by = "cap"
+        if self.ended_by is None:
+            return False
+
+        self.ended_at = state['now']
+        try:
+            driver.execute_script(EXPORT_SCRIPT)
+        except WebDriverException as e:
+            log.error(f"Error forcing the HAR export: {e.msg}")
+        return True
+
+    def finish(self, har):
+        # What ended the visit, 'load', 'idle', 'cap' or 'timeout' if there
+        # is no HAR, and when, in milliseconds since navigation started
+        if not har:
+            self.ended_by = "timeout"
+        elif self.ended_by is None:
+            self.ended_by = "load"
+        return {'idle': self.idle,
+                'cap': self.cap,
+                'ended_by': self.ended_by,
+                'ended_at': round(self.ended_at, 1) if self.ended_at is not None else None}
+
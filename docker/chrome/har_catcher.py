@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-import pathlib
+import socket
 import struct
 import sys
 
+HAR_SOCKET = "/home/seluser/measure/har.sock"
+
 try:
     def get_message():
         raw_length = sys.stdin.buffer.read(4)
@@ -19,9 +20,10 @@ try:
 
     while True:
         message = get_message()
-        with open("har.json", 'wb') as f:
-            f.write(message)
-        pathlib.Path("har.json.ready").touch()
+        # Stream the HAR straight to run.py, which is waiting for it
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(HAR_SOCKET)
+            connection.sendall(message)
 
 except Exception as e:
     print("Couldn't save HAR:", e)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import base64
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+
+from selenium.common.exceptions import TimeoutException
+
+# A request that every blocker ships a filter for (EasyList filters the path,
+# Disconnect the domain), it is only blocked once the filter lists of the
+# extension have been loaded and compiled. The browser
+# resolves the host to the loopback address and does not send it through the
+# proxy, so that probing neither reaches an ad server nor is recorded or
+# missed by a replay. No HTTPS Everywhere rule upgrades the host.
+PROBE_HOST = "probe.adnxs.com"
+PROBE_PATH = "/pagead/ads"
+
+BLOCKING_EXTENSIONS = ("adblock_plus",
+                       "disconnect",
+                       "ghostery_privacy_ad_blocker",
+                       "ublock_origin")
+
+# Fetches the probe, a fetch is rejected immediately if an extension blocks it
+PROBE_SCRIPT = """
+    var done = arguments[arguments.length - 1];
+    var options = {mode: 'no-cors', cache: 'no-store', credentials: 'omit'};
+    fetch(arguments[0], options).then(function() { done(true); },
+                                      function() { done(false); });
+"""
+
+
+def _varint(data, offset):
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def _protobuf_fields(data, number):
+    offset = 0
+    while offset < len(data):
+        key, offset = _varint(data, offset)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            _, offset = _varint(data, offset)
+            continue
+        if wire_type != 2:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        length, offset = _varint(data, offset)
+        if key >> 3 == number:
+            yield data[offset:offset + length]
+        offset += length
+
+
+def _protobuf_field(data, number):
+    return next(_protobuf_fields(data, number), None)
+
+
+def _extension_id(digest):
+    return digest[:16].hex().translate(str.maketrans("0123456789abcdef", "abcdefghijklmnop"))
+
+
+def read_crx(path):
+    # Returns the ID, the public key and the ZIP archive of a CRX file. Chrome
+    # derives the extension ID from the signing key, which is stored in the
+    # CRX header. A CRX 3 file may carry proofs of several keys, the ID is in
+    # the signed part of the header.
+    with open(path, 'rb') as f:
+        magic, version, length = struct.unpack('<4sII', f.read(12))
+        if magic != b"Cr24":
+            raise ValueError(f"'{path}' is not a CRX file")
+
+        if version == 2:
+            signature_length, = struct.unpack('<I', f.read(4))
+            key = f.read(length)
+            f.read(signature_length)
+            return _extension_id(hashlib.sha256(key).digest()), key, f.read()
+
+        header = f.read(length)
+        digest = _protobuf_field(_protobuf_field(header, 10000), 1)
+        for proof in (*_protobuf_fields(header, 2), *_protobuf_fields(header, 3)):
+            key = _protobuf_field(proof, 1)
+            if hashlib.sha256(key).digest()[:16] == digest:
+                return _extension_id(digest), key, f.read()
+    raise ValueError(f"'{path}' has no proof for the key of its ID")
+
+
+def crx_id(path):
+    return read_crx(path)[0]
+
+
+def extension_id(path):
+    # Of a CRX file, or of an unpacked extension with the key in its manifest
+    if not os.path.isdir(path):
+        return crx_id(path)
+    with open(os.path.join(path, "manifest.json"), encoding='utf-8-sig') as f:
+        key = base64.b64decode(json.load(f)['key'])
+    return _extension_id(hashlib.sha256(key).digest())
+
+
+def background_pages(driver):
+    targets = driver.execute_cdp_cmd("Target.getTargets", {})['targetInfos']
+    return {target['url'].split('/')[2]
+            for target in targets
+            if target['type'] == 'background_page'
+            and target['url'].startswith("chrome-extension://")}
+
+
+class _ProbeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.received.add(self.path)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def probe_server():
+    # Answers the probe on the loopback address, yields its URL
+    server = http.server.HTTPServer(("127.0.0.1", 0), _ProbeHandler)
+    server.received = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, f"http://{PROBE_HOST}:{server.server_port}{PROBE_PATH}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def probe_blocked(driver, server, url, timeout):
+    # Whether the probe was blocked, that is it failed without reaching the
+    # server
+    query = uuid.uuid4().hex
+    driver.set_script_timeout(timeout)
+    try:
+        succeeded = driver.execute_async_script(PROBE_SCRIPT, f"{url}?{query}")
+    except TimeoutException:
+        return False
+    return not succeeded and f"{PROBE_PATH}?{query}" not in server.received
+
+
+def wait_until_ready(driver, extensions, ceiling, interval=0.1):
+    # `extensions` maps extension names to their CRX files or unpacked
+    # directories. We wait until the background page of every extension is up
+    # and, for blockers, until a request to the probe is actually blocked.
+    started = time.monotonic()
+    ids = {name: extension_id(path) for name, path in extensions.items()}
+    ready = {name: None for name in ids}
+    blocking = any(name in BLOCKING_EXTENSIONS for name in ids)
+    blocked = None
+
+    with probe_server() as (server, url):
+        while time.monotonic() - started < ceiling:
+            elapsed = time.monotonic() - started
+            loaded = background_pages(driver)
+            for name, extension_id in ids.items():
+                if ready[name] is None and extension_id in loaded:
+                    ready[name] = elapsed
+
+            if blocking and blocked is None and all(v is not None for v in ready.values()):
+                # The probe must not overrun the ceiling
+                remaining = max(ceiling - (time.monotonic() - started), interval)
+                probed = probe_blocked(driver, server, url, remaining)
+                if probed:
+                    blocked = time.monotonic() - started
+
+            if all(v is not None for v in ready.values()) and (not blocking or blocked is not None):
+                break
+            time.sleep(interval)
+
+    elapsed = time.monotonic() - started
+    return {'elapsed': elapsed,
+            'ceiling': ceiling,
+            'timed_out': elapsed >= ceiling,
+            'extensions': ready,
+            'blocked': blocked}
@@ -2,88 +2,389 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import base64
+import contextlib
+import io
 import json
+import os
 import pathlib
 import shutil
+import socket
 import subprocess
 import sys
+import tempfile
 import time
+import traceback
+import zipfile
 
-from datetime import datetime
-
+import completion
 import perfevents
+import readiness
+import timeline
 
 from pyvirtualdisplay import Display
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
+HAR_SOCKET = "/home/seluser/measure/har.sock"
 
-def main():
-    # Parse the command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument('website')
-    parser.add_argument('--timeout', type=int, default=30)
-    parser.add_argument('--extensions')
-    parser.add_argument('--extensions-wait', type=int, default=15)
-    args = parser.parse_args()
+# Our extension for getting HARs, by whether the visit waits for the load
+# event. Those visits get the signed release, the completion policy needs the
+# version built from our source, which exports when it is told to, unpacked.
+HAR_EXTENSIONS = {True: "/home/seluser/measure/harexporttrigger-0.6.3.crx",
+                  False: "/home/seluser/measure/harexporttrigger"}
 
-    # Start X
-    vdisplay = Display(visible=False, size=(1920, 1080))
-    vdisplay.start()
+# The profiles baked at build time, visits start from copies on a tmpfs
+PROFILES = "/home/seluser/profiles"
+PROFILE_TMPFS = "/tmp/profiles"
+
+# How long the extensions get to store what they compiled once they are ready
+BAKE_SETTLE = 10
+
+# The extensions of the baked profiles, unpacked once at build time
+EXTENSIONS = os.path.join(PROFILES, "extensions")
+
+# Turn the automatic filter list updates of the blockers off through their
+# own settings, so that the lists stay as they were baked, or date the last
+# update in 2100. Every script runs in a page of its extension when the
+# profile is baked. uBlock Origin is turned off by its managed settings in
+# policies/ instead, and Privacy Badger, which has no setting for it, is kept
+# from its update host by a policy too.
+FREEZE_LIST_UPDATES = {
+    'adblock_plus': ("options.html", """
+        var done = arguments[arguments.length - 1];
+        chrome.storage.local.get("pref:notificationdata", function(items) {
+            var notifications = items["pref:notificationdata"] || {};
+            notifications.softExpiration = notifications.hardExpiration = 4102444800000;
+            chrome.storage.local.set({"pref:subscriptions_autoupdate": false,
+                                      "pref:notificationdata": notifications}, done);
+        });
+    """),
+    'disconnect': ("markup/popup.html", """
+        localStorage.lastUpdateTime = 4102444800000;
+        arguments[arguments.length - 1]();
+    """),
+    'https_everywhere': ("pages/options/index.html", """
+        var done = arguments[arguments.length - 1];
+        chrome.storage.sync.set({autoUpdateRulesets: false}, function() {
+            chrome.storage.local.set({autoUpdateRulesets: false}, done);
+        });
+    """)}
+
+
+def listen_for_har():
+    # har_catcher.py connects to this socket and streams the HAR to us
+    if os.path.exists(HAR_SOCKET):
+        os.unlink(HAR_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(HAR_SOCKET)
+    server.listen(1)
+    return server
+
+
+def receive_har(server, deadline, policy=None, driver=None, interval=0.1):
+    # Wake up as soon as har_catcher.py has sent the last byte and closed the
+    # connection, or give up at the deadline. Until har_catcher.py connects,
+    # the completion policy may force the export.
+    chunks = []
+    polling = policy is not None and not policy.waits_for_load
+    try:
+        while True:
+            remaining = max(deadline - time.monotonic(), 0.001)
+            server.settimeout(min(remaining, interval) if polling else remaining)
+            try:
+                connection, _ = server.accept()
+                break
+            except socket.timeout:
+                if not polling or time.monotonic() >= deadline:
+                    raise
+                policy.poll(driver)
+        with connection:
+            while True:
+                connection.settimeout(max(deadline - time.monotonic(), 0.001))
+                chunk = connection.recv(1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except socket.timeout:
+        return {}
+
+    if not chunks:
+        return {}
+    return json.loads(b"".join(chunks))
+
+
+def profile_path(extensions):
+    return os.path.join(PROFILES, extensions or "none")
+
+
+def extension_files(extensions):
+    # The CRX files of the addons
+    crx_files = {}
+    extensions_path = pathlib.Path("/home/seluser/measure/extensions")
+    if extensions:
+        for extension in extensions.split(","):
+            matches = list(extensions_path.glob("{}*.crx".format(extension)))
+            if matches and len(matches) == 1:
+                crx_files[extension] = str(matches[0])
+    return crx_files
+
+
+def extension_version(path):
+    # Of a CRX file or of an unpacked extension
+    if os.path.isdir(path):
+        with open(os.path.join(path, "manifest.json"), encoding='utf-8-sig') as f:
+            return json.load(f)['version']
+    _, _, archive = readiness.read_crx(path)
+    with zipfile.ZipFile(io.BytesIO(archive)) as f:
+        return json.loads(f.read("manifest.json").decode('utf-8-sig'))['version']
+
+
+def unpack_extensions(crx_files):
+    # Chromedriver unpacks every CRX into a new temporary directory on every
+    # launch, which Chrome then installs again. The baked profiles load the
+    # extensions from here instead. The key of the CRX in the manifest keeps
+    # the ID, under which the profiles store the data of the extension.
+    for extension, crx_file in crx_files.items():
+        path = os.path.join(EXTENSIONS, extension)
+        shutil.rmtree(path, ignore_errors=True)
+        _, key, archive = readiness.read_crx(crx_file)
+        with zipfile.ZipFile(io.BytesIO(archive)) as f:
+            f.extractall(path)
+
+        manifest_path = os.path.join(path, "manifest.json")
+        with open(manifest_path, encoding='utf-8-sig') as f:
+            manifest = json.load(f)
+        manifest['key'] = base64.b64encode(key).decode('ascii')
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+
+@contextlib.contextmanager
+def copy_profile(extensions):
+    # Every visit gets its own copy of the baked profile of its configuration,
+    # or a fresh temporary profile if there is none
+    baked = profile_path(extensions)
+    if not os.path.isdir(baked):
+        yield None, {'baked': False}
+        return
 
-    # Prepare Chrome
+    with open(f"{baked}.json") as f:
+        metadata = json.load(f)
+    started = time.monotonic()
+    tmp = tempfile.mkdtemp(dir=PROFILE_TMPFS if os.path.isdir(PROFILE_TMPFS) else None)
+    try:
+        profile = os.path.join(tmp, "profile")
+        shutil.copytree(baked, profile, symlinks=True)
+        yield profile, {'baked': True,
+                        'built': metadata['built'],
+                        'copy': time.monotonic() - started}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def visit(website, extensions, timeout, extensions_wait, proxy=None, perf_interval=None,
+          idle=None, idle_cap=None):
+    # Listen for the HAR before the browser, and with it har_catcher.py, starts
+    with listen_for_har() as har_socket, copy_profile(extensions) as (profile, metadata):
+        document = _visit(har_socket, website, extensions, timeout, extensions_wait, proxy,
+                          perf_interval, idle, idle_cap, profile)
+    document['profile'] = metadata
+    return document
+
+
+def launch(extensions, proxy=None, profile=None, wait_for_load=True):
+    # Prepare Chrome, every launch gets a fresh temporary profile unless it is
+    # given one, the extensions of a baked profile are unpacked already
     options = Options()
     options.headless = False
     options.add_argument("no-sandbox")
     options.add_argument("auto-open-devtools-for-tabs")
-    options.add_extension("/home/seluser/measure/harexporttrigger-0.6.3.crx")
     options.binary_location = "/usr/bin/google-chrome-stable"
+    if profile:
+        options.add_argument(f"user-data-dir={profile}")
 
-    # Install other addons
-    extensions_path = pathlib.Path("/home/seluser/measure/extensions")
-    if args.extensions:
-        for extension in args.extensions.split(","):
-            matches = list(extensions_path.glob("{}*.crx".format(extension)))
-            if matches and len(matches) == 1:
-                options.add_extension(str(matches[0]))
+    # The completion policy decides when the page is done instead
+    if not wait_for_load:
+        options.capabilities['pageLoadStrategy'] = "none"
+
+    # The record/replay proxy intercepts TLS with its own certificates, the
+    # probe of the readiness check does not go through it
+    if proxy:
+        options.add_argument(f"proxy-server={proxy}")
+        options.add_argument(f"proxy-bypass-list={readiness.PROBE_HOST}")
+        options.add_argument("ignore-certificate-errors")
+
+    # The probe is answered on the loopback address
+    options.add_argument(f"host-resolver-rules=MAP {readiness.PROBE_HOST} 127.0.0.1")
+
+    # Install our extension for getting HARs and the other addons
+    har_extension = HAR_EXTENSIONS[wait_for_load]
+    crx_files = extension_files(extensions)
+    unpacked = []
+    if os.path.isdir(har_extension):
+        unpacked.append(har_extension)
+    else:
+        options.add_extension(har_extension)
+    if profile:
+        unpacked += [os.path.join(EXTENSIONS, extension) for extension in crx_files]
+    else:
+        for crx_file in crx_files.values():
+            options.add_extension(crx_file)
+    if unpacked:
+        options.add_argument("load-extension={}".format(",".join(unpacked)))
+
+    # Launch Chrome
+    return webdriver.Chrome(options=options), {'harexporttrigger': har_extension, **crx_files}
+
+
+def _visit(har_socket, website, extensions, timeout, extensions_wait, proxy=None,
+           perf_interval=None, idle=None, idle_cap=None, profile=None):
+    policy = completion.CompletionPolicy(idle, idle_cap)
+    driver, crx_files = launch(extensions, proxy, profile, policy.waits_for_load)
+    try:
+        driver.set_page_load_timeout(timeout)
+
+        # Start perf timer
+        perf = perfevents.PerfEvents(timeout, perf_interval)
+
+        # We need to wait for everything to open up properly, but no longer
+        # than the extensions actually need to initialise
+        ready = readiness.wait_until_ready(driver, crx_files, extensions_wait)
+
+        # Make a page load
+        perf.start()
+        deadline = time.monotonic() + timeout
+        driver.get(website)
 
-    # Launch Chrome and install our extension for getting HARs
-    driver = webdriver.Chrome(options=options)
-    driver.set_page_load_timeout(args.timeout)
+        # Once the browser exported the HAR, har_catcher.py hands it to us so
+        # we can write it to stdout for the host machine
+        har = receive_har(har_socket, deadline, policy, driver)
 
-    # Start perf timer
-    perf = perfevents.PerfEvents(args.timeout)
+        # Stop collecting performance data
+        perf_data = perf.stop()
 
-    # We need to wait for everything to open up properly
-    time.sleep(args.extensions_wait)
+        # The browser's own view of the page load, once perf stopped counting
+        page_timeline = timeline.collect(driver)
+    finally:
+        driver.quit()
 
-    # Make a page load
-    perf.start()
-    started = datetime.now()
-    driver.get(args.website)
+    document = {'har': har, 'perf': perf_data, 'ready': ready, 'timeline': page_timeline,
+                'completion': policy.finish(har),
+                'exporter': extension_version(crx_files['harexporttrigger'])}
+    if perf.samples:
+        document['perf_samples'] = perfevents.align(perf.samples, har)
+    return document
 
-    # Once the HAR is on disk in the container, write it to stdout so the host machine can get it
-    har_file = "/home/seluser/measure/har.json"
 
-    def har_file_ready():
-        return pathlib.Path(har_file + ".ready").exists()
+def freeze_list_updates(driver, crx_files):
+    driver.set_script_timeout(10)
+    for extension, path in crx_files.items():
+        if extension in FREEZE_LIST_UPDATES:
+            page, script = FREEZE_LIST_UPDATES[extension]
+            driver.get(f"chrome-extension://{readiness.extension_id(path)}/{page}")
+            driver.execute_async_script(script)
 
-    while (datetime.now() - started).total_seconds() < args.timeout and not har_file_ready():
-        time.sleep(1)
 
-    # Stop collecting performance data
-    perf_data = perf.stop()
+def bake(configurations, extensions_wait):
+    # Launches Chrome once for every configuration with a profile of its own,
+    # which is kept once the extensions are ready and the blockers have
+    # compiled their filter lists
+    unpack_extensions(extension_files(",".join(configurations)))
+    for extensions in ["", *configurations]:
+        path = profile_path(extensions)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        driver, crx_files = launch(extensions, profile=path)
+        try:
+            ready = readiness.wait_until_ready(driver, crx_files, extensions_wait)
+            time.sleep(BAKE_SETTLE)
+            freeze_list_updates(driver, crx_files)
+        finally:
+            driver.quit()
 
-    # Read HAR file
-    har = {}
-    if har_file_ready():
-        with open(har_file, 'r') as f:
-            har = json.load(f)
+        if ready['timed_out']:
+            raise RuntimeError(f"Extensions of '{extensions}' were not ready after "
+                               f"{extensions_wait}s: {ready}")
+        with open(f"{path}.json", 'w') as f:
+            json.dump({'built': time.time(), 'ready': ready}, f)
+        print(f"Baked a profile for '{extensions}' in {ready['elapsed']:.1f}s",
+              file=sys.stderr)
 
-    driver.quit()
-    vdisplay.stop()
 
-    json.dump({'har': har, 'perf': perf_data}, sys.stdout)
+def serve(args):
+    # Every request is a single line of JSON, every response is a header line
+    # with the status and payload length followed by the payload itself
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            document = visit(request['website'],
+                             request.get('extensions'),
+                             request.get('timeout', args.timeout),
+                             request.get('extensions_wait', args.extensions_wait),
+                             request.get('proxy', args.proxy),
+                             request.get('perf_interval', args.perf_interval),
+                             request.get('idle', args.idle),
+                             request.get('idle_cap', args.idle_cap))
+            status, payload = "ok", json.dumps(document)
+        except Exception:
+            status, payload = "error", traceback.format_exc()
+
+        payload = payload.encode('utf-8')
+        sys.stdout.buffer.write(f"{status} {len(payload)}\n".encode('utf-8'))
+        sys.stdout.buffer.write(payload)
+        sys.stdout.buffer.flush()
+
+
+def main():
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('website', nargs='?')
+    parser.add_argument('--timeout', type=int, default=30)
+    parser.add_argument('--extensions')
+    parser.add_argument('--extensions-wait', type=int, default=15,
+                        help="maximum number of seconds to wait for the extensions to be ready")
+    parser.add_argument('--serve', action='store_true',
+                        help="serve visit requests from stdin until EOF")
+    parser.add_argument('--perf-interval', type=int, metavar='MS',
+                        help="also sample the perf counters every MS milliseconds")
+    parser.add_argument('--idle', type=int, metavar='MS',
+                        help="end the visit once no response finished for MS "
+                             "milliseconds after the load event, instead of right at it")
+    parser.add_argument('--idle-cap', type=int, metavar='MS',
+                        help="end the visit MS milliseconds after the navigation started "
+                             "at the latest, whether the page loaded or not")
+    parser.add_argument('--proxy', metavar='HOST:PORT',
+                        help="send all traffic through this HTTP(S) proxy, whose "
+                             "certificates are trusted")
+    parser.add_argument('--bake', nargs='*', metavar='CONFIGURATION',
+                        help="bake a profile for no extensions and every configuration")
+    parser.add_argument('--bake-wait', type=int, default=300,
+                        help="maximum number of seconds to wait for the extensions of "
+                             "a baked profile to be ready")
+    args = parser.parse_args()
+
+    if not args.serve and not args.website and args.bake is None:
+        parser.error("a website is required unless --serve or --bake is given")
+
+    # Start X
+    vdisplay = Display(visible=False, size=(1920, 1080))
+    vdisplay.start()
+
+    try:
+        if args.bake is not None:
+            bake(args.bake, args.bake_wait)
+        elif args.serve:
+            serve(args)
+        else:
+            document = visit(args.website, args.extensions, args.timeout,
+                             args.extensions_wait, args.proxy, args.perf_interval,
+                             args.idle, args.idle_cap)
+            json.dump(document, sys.stdout)
+    finally:
+        vdisplay.stop()
 
 
 if __name__ == '__main__':
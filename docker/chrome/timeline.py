@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+
+from selenium.common.exceptions import WebDriverException
+
+log = logging.getLogger('timeline')
+
+# Times are in milliseconds since navigation started, like the page timings of
+# the HAR, sizes in bytes. Entry types the browser does not support are null,
+# so that they can be told apart from pages that had none of them.
+TIMELINE_SCRIPT = """
+    var done = arguments[arguments.length - 1];
+    var round = function(value) { return Math.round(value * 10) / 10; };
+    var supported = PerformanceObserver.supportedEntryTypes || [];
+
+    // LCP and long tasks are only reported to observers, buffered observers
+    // get those that happened before they were created in a task of their own
+    var entries = {};
+    var observers = ['largest-contentful-paint', 'longtask'].filter(function(type) {
+        return supported.indexOf(type) >= 0;
+    }).map(function(type) {
+        entries[type] = [];
+        var observer = new PerformanceObserver(function(list) {
+            entries[type] = entries[type].concat(list.getEntries());
+        });
+        observer.observe({type: type, buffered: true});
+        return [type, observer];
+    });
+
+    setTimeout(function() {
+        observers.forEach(function(item) {
+            entries[item[0]] = entries[item[0]].concat(item[1].takeRecords());
+            item[1].disconnect();
+        });
+
+        var timeline = {navigation: null, paint: {}, lcp: null, long_tasks: null, heap: null};
+
+        var navigation = performance.getEntriesByType('navigation')[0];
+        if (navigation) {
+            timeline.navigation = {type: navigation.type};
+            ['redirectEnd', 'domainLookupStart', 'domainLookupEnd', 'connectStart',
+             'secureConnectionStart', 'connectEnd', 'requestStart', 'responseStart',
+             'responseEnd', 'domInteractive', 'domContentLoadedEventStart',
+             'domContentLoadedEventEnd', 'domComplete', 'loadEventStart', 'loadEventEnd',
+             'duration'].forEach(function(key) {
+                timeline.navigation[key] = round(navigation[key]);
+            });
+            timeline.navigation.transferSize = navigation.transferSize;
+            timeline.navigation.decodedBodySize = navigation.decodedBodySize;
+        }
+
+        performance.getEntriesByType('paint').forEach(function(entry) {
+            timeline.paint[entry.name] = round(entry.startTime);
+        });
+
+        if (entries['largest-contentful-paint']) {
+            var lcp = entries['largest-contentful-paint'].slice(-1)[0];
+            timeline.lcp = lcp ? {time: round(lcp.startTime),
+                                  size: lcp.size,
+                                  element: lcp.element ? lcp.element.tagName : null,
+                                  url: lcp.url || null} : {};
+        }
+
+        // The blocking time is the part of every task beyond 50ms
+        if (entries['longtask']) {
+            var tasks = entries['longtask'];
+            var durations = tasks.map(function(entry) { return entry.duration; });
+            timeline.long_tasks = {
+                count: tasks.length,
+                total: round(durations.reduce(function(a, b) { return a + b; }, 0)),
+                max: round(Math.max.apply(null, durations.concat([0]))),
+                blocking: round(durations.reduce(function(a, b) {
+                    return a + Math.max(b - 50, 0);
+                }, 0)),
+                first: tasks.length ? round(tasks[0].startTime) : null
+            };
+        }
+
+        // Only Chrome exposes the size of the JavaScript heap
+        if (performance.memory) {
+            timeline.heap = {used: performance.memory.usedJSHeapSize,
+                             total: performance.memory.totalJSHeapSize,
+                             limit: performance.memory.jsHeapSizeLimit};
+        }
+        done(timeline);
+    }, 100);
+"""
+
+
+def collect(driver, timeout=5):
+    # Reads the performance timeline of the page that is loaded, the page can
+    # be unresponsive after a timeout, so this gives up after a few seconds
+    try:
+        driver.set_script_timeout(timeout)
+        return driver.execute_async_script(TIMELINE_SCRIPT)
+    except WebDriverException as e:
+        log.error(f"Error collecting the performance timeline: {e.msg}")
+        return None
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# The extension configurations that every domain is visited with. The browser
+# images bake a profile for each of them, `make docker` passes those with
+# extensions to the build.
+CONFIGURATIONS = [
+    # No extensions
+    "",
+    # Extensions on their own
+    "adblock_plus",
+    "decentraleyes",
+    "disconnect",
+    "ghostery_privacy_ad_blocker",
+    "https_everywhere",
+    "noscript_security_suite",
+    "privacy_badger",
+    "ublock_origin",
+    # Combinations
+    "decentraleyes,privacy_badger,ublock_origin"
+]
+
+
+if __name__ == '__main__':
+    print(" ".join(extensions for extensions in CONFIGURATIONS if extensions))
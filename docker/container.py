@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import uuid
+
+log = logging.getLogger('container')
+
+# Every container of a run is labelled with the host, the PID and the start
+# time of the process that started it, so that the containers of runs that
+# crashed can be told apart from those of runs that are still going, also on a
+# Docker daemon that several hosts share and after PIDs have been reused
+OWNER_LABEL = "privacy-extensions.owner"
+
+
+class VisitTimeout(Exception):
+    pass
+
+
+def _start_time(pid):
+    # In clock ticks since boot, or None without /proc
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The name of the command in the second field may contain spaces
+            return f.read().rpartition(")")[2].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def owner():
+    pid = os.getpid()
+    return f"{socket.gethostname()}/{pid}/{_start_time(pid) or ''}"
+
+
+def labels():
+    return ["--label", f"{OWNER_LABEL}={owner()}"]
+
+
+def _alive(owner):
+    # Processes on other hosts cannot be checked, so they count as alive
+    host, _, rest = owner.partition("/")
+    pid, _, start_time = rest.partition("/")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # A different start time means that the PID has been reused
+    current = _start_time(int(pid))
+    return not start_time or current is None or current == start_time
+
+
+def reap_orphans(unlabelled=False):
+    # Kills and removes the containers of runs on this host whose process is
+    # gone. Containers without a label may belong to an older version that is
+    # still running, they are only removed if `unlabelled` is set.
+    run = subprocess.run(["docker", "ps", "-a", "--filter", "name=^privacy-extensions-",
+                          "--format", f'{{{{.Names}}}}\t{{{{.Label "{OWNER_LABEL}"}}}}'],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    orphans = []
+    for line in run.stdout.decode('utf-8').splitlines():
+        name, _, label = line.partition("\t")
+        if label and label != "<no value>":
+            if not _alive(label):
+                orphans.append(name)
+        elif unlabelled:
+            orphans.append(name)
+
+    if orphans:
+        log.warning(f"Removing {len(orphans)} orphaned containers: {', '.join(orphans)}")
+        subprocess.run(["docker", "rm", "-f", *orphans],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return orphans
+
+
+def kill(name):
+    subprocess.run(["docker", "rm", "-f", name],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Visits every website in a brand-new container. A visit that takes longer
+# than the budget, in seconds, is killed along with its container.
+class Container:
+    def __init__(self, browser, docker_args=None, address=None, run_args=None, budget=None):
+        self.browser = browser
+        self.budget = budget
+        self._docker_args = docker_args or []
+        # The fixed IP address of the container on its network, if any
+        self.address = address
+        # Arguments for run.py that apply to every visit
+        self._run_args = run_args or []
+
+    def _command(self, *args):
+        return ["docker", "run", "--rm",
+                "--security-opt", "seccomp=seccomp.json",
+                "--cap-add", "SYS_ADMIN",
+                *labels(),
+                # run.py copies the baked profile of every visit here
+                "--tmpfs", "/tmp/profiles:rw,mode=1777",
+                *self._docker_args,
+                *args,
+                f"privacy-extensions-{self.browser}"]
+
+    def visit(self, extensions, website, monitor=None, timeout=None):
+        # The monitor samples the cgroup of the container, which is only known
+        # once docker has written its ID to the cidfile. The timeout of the
+        # page load overrides that of run.py.
+        name = f"privacy-extensions-{self.browser}-{uuid.uuid4().hex[:12]}"
+        with tempfile.TemporaryDirectory() as tmp:
+            cidfile = os.path.join(tmp, "cid")
+            cmd = (self._command("--name", name, "--cidfile", cidfile) + self._run_args
+                   + (["--timeout", str(timeout)] if timeout else [])
+                   + ["--extensions", extensions, website])
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if monitor:
+                monitor.watch(cidfile=cidfile)
+            try:
+                stdout, stderr = process.communicate(timeout=self.budget)
+            except subprocess.TimeoutExpired:
+                log.warning(f"Killing container '{name}' after {self.budget}s")
+                kill(name)
+                process.kill()
+                process.communicate()
+                raise VisitTimeout(f"No result from '{name}' after {self.budget}s")
+            finally:
+                if monitor:
+                    monitor.stop()
+        return stdout, stderr
+
+    def stop(self):
+        pass
+
+
+# Visits many websites in one long-lived container. The container runs
+# `run.py --serve`, which launches a fresh browser with a fresh profile for
+# every request, so visits stay isolated from each other while Xvfb, Python and
+# the container itself are only started once.
+class PersistentContainer(Container):
+    def __init__(self, browser, docker_args=None, address=None, run_args=None, budget=None):
+        super().__init__(browser, docker_args, address, run_args, budget)
+        self._process = None
+        self.name = None
+        self._overran = False
+
+    def start(self):
+        self._overran = False
+        self.name = f"privacy-extensions-{self.browser}-{uuid.uuid4().hex[:12]}"
+        cmd = self._command("-i", "--name", self.name) + self._run_args + ["--serve"]
+        log.info(f"Starting persistent container '{self.name}'")
+        self._process = subprocess.Popen(cmd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _kill(self, name, process):
+        # Runs on the watchdog thread, the visit sees the container exit
+        self._overran = True
+        log.warning(f"Killing persistent container '{name}' after {self.budget}s")
+        kill(name)
+        process.kill()
+
+    def visit(self, extensions, website, monitor=None, timeout=None):
+        if not self.running():
+            self.start()
+        if monitor:
+            monitor.watch(self.name)
+
+        request = {'website': website, 'extensions': extensions}
+        if timeout:
+            request['timeout'] = timeout
+        request = json.dumps(request)
+        watchdog = None
+        if self.budget:
+            watchdog = threading.Timer(self.budget, self._kill, (self.name, self._process))
+            watchdog.start()
+        try:
+            self._process.stdin.write(request.encode('utf-8') + b"\n")
+            self._process.stdin.flush()
+
+            header = self._process.stdout.readline()
+            if not header:
+                raise RuntimeError(f"Container '{self.name}' exited unexpectedly")
+            status, length = header.decode('utf-8').split()
+            payload = self._process.stdout.read(int(length))
+        except Exception:
+            # The container is in an unknown state, start over on the next visit
+            self.stop()
+            if self._overran:
+                raise VisitTimeout(f"No result from '{self.name}' after {self.budget}s")
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if monitor:
+                monitor.stop()
+
+        if status == "ok":
+            return payload, b""
+        return b"", payload
+
+    def stop(self):
+        if self._process is None:
+            return
+
+        try:
+            self._process.stdin.close()
+            self._process.wait(timeout=30)
+        except Exception:
+            log.warning(f"Killing persistent container '{self.name}'")
+            subprocess.run(["docker", "kill", self.name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._process.wait()
+        self._process = None
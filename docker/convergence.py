@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Decides which visits a series of measurement passes still needs. Every
+# configuration of a domain is compared with the same domain without
+# extensions, a pair has converged once the 95% confidence intervals of the
+# differences of its mean onLoad and resource count are narrow enough.
+#
+# Exits with 0 while another pass is needed, and with DONE once every pair
+# has converged or was given up on, or after the maximum number of passes.
+# Any other status, like 1 for an exception, is an error. experiments/run.sh
+# drives its passes with it.
+
+import argparse
+import math
+import statistics
+import sys
+
+from configurations import CONFIGURATIONS
+from database import Database
+
+METRICS = ('onload', 'resources')
+
+# The exit status once no further pass is needed
+DONE = 2
+
+# The half-width of a confidence interval has to be within this fraction of
+# the mean of the baseline, or within the absolute floor of the metric
+PRECISION = 0.05
+FLOORS = {'onload': 50, 'resources': 1}
+
+# Every pair is visited at least this often before it can converge
+MIN_PASSES = 3
+
+# Pairs that failed in this many passes without a single success are given up
+MAX_FAILURES = 3
+
+# The 97.5% quantiles of Student's t distribution up to 30 degrees of freedom
+_T = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+      2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+      2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+_Z = 1.959964
+
+
+def t_quantile(df):
+    # Fractional degrees of freedom are rounded down, which widens the
+    # interval. Beyond the table, the Cornish-Fisher expansion around the
+    # normal quantile is close enough.
+    df = max(int(df), 1)
+    if df <= len(_T):
+        return _T[df - 1]
+    z = _Z
+    return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+
+
+def half_width(samples, baseline):
+    # Of the 95% confidence interval of the difference of the means, with
+    # Welch's approximation of the degrees of freedom
+    if len(samples) < 2 or len(baseline) < 2:
+        return math.inf
+    a = statistics.variance(samples) / len(samples)
+    b = statistics.variance(baseline) / len(baseline)
+    if a + b == 0:
+        return 0.0
+    df = (a + b) ** 2 / (a ** 2 / (len(samples) - 1) + b ** 2 / (len(baseline) - 1))
+    return t_quantile(df) * math.sqrt(a + b)
+
+
+def collect(rows):
+    # The values of every metric of the successful visits of every pair, and
+    # the passes that every pair failed in
+    samples, failures = {}, {}
+    for row in rows:
+        pair = (row['domain'], row['extensions'])
+        if row['error'] or row['onload'] is None:
+            failures.setdefault(pair, set()).add(row['experiment'])
+            continue
+        values = samples.setdefault(pair, {metric: [] for metric in METRICS})
+        for metric in METRICS:
+            values[metric].append(row[metric])
+    return samples, failures
+
+
+def pair_status(samples, baseline, failures, precision=PRECISION, min_passes=MIN_PASSES):
+    # 'converged', 'failing' when the pair was given up on, or 'pending'
+    if not samples and failures >= MAX_FAILURES:
+        return 'failing'
+    if not samples or len(samples['onload']) < min_passes:
+        return 'pending'
+    if not baseline or len(baseline['onload']) < min_passes:
+        return 'pending'
+
+    for metric in METRICS:
+        target = max(precision * abs(statistics.mean(baseline[metric])), FLOORS[metric])
+        if half_width(samples[metric], baseline[metric]) > target:
+            return 'pending'
+    return 'converged'
+
+
+def pending_pairs(rows, domains, configurations=CONFIGURATIONS, precision=PRECISION,
+                  min_passes=MIN_PASSES):
+    # The (extensions, domain) pairs that need another pass, the baseline of
+    # a domain is visited again as long as any of its pairs is, and the
+    # number of pairs by status
+    samples, failures = collect(rows)
+    pending, counts = set(), {'converged': 0, 'pending': 0, 'failing': 0}
+    for domain in domains:
+        baseline = samples.get((domain, ""))
+        # Without a baseline, no pair of the domain can ever converge
+        unreachable = not baseline and len(failures.get((domain, ""), ())) >= MAX_FAILURES
+        for extensions in configurations:
+            if not extensions:
+                continue
+            pair = (domain, extensions)
+            status = 'failing' if unreachable else \
+                pair_status(samples.get(pair), baseline, len(failures.get(pair, ())),
+                            precision, min_passes)
+            counts[status] += 1
+            if status == 'pending':
+                pending |= {(extensions, domain), ("", domain)}
+    return pending, counts
+
+
+def read_passes(path):
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def pass_results(database, passes):
+    if not passes:
+        return []
+    rv = database.get_pass_results(passes)
+    if isinstance(rv, Exception):
+        raise rv
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check whether a series of passes needs another one")
+    parser.add_argument('database_config_file')
+    parser.add_argument('domains_list_file')
+    parser.add_argument('passes_file',
+                        help="the UUIDs of the completed passes, one per line")
+    parser.add_argument('--precision', type=float, default=PRECISION)
+    parser.add_argument('--min-passes', type=int, default=MIN_PASSES)
+    parser.add_argument('--max-passes', type=int,
+                        help="stop after this many passes even if pairs have not converged")
+    args = parser.parse_args()
+
+    with open(args.domains_list_file, 'r') as f:
+        domains = [line.strip() for line in f]
+
+    passes = read_passes(args.passes_file)
+    database = Database.init_from_config_file(args.database_config_file)
+    try:
+        pending, counts = pending_pairs(pass_results(database, passes), domains,
+                                        precision=args.precision,
+                                        min_passes=args.min_passes)
+    finally:
+        database.close()
+
+    print(f"{len(passes)} passes: {counts['converged']} pairs converged, "
+          f"{counts['pending']} pending, {counts['failing']} failing")
+    if not pending:
+        sys.exit(DONE)
+    if args.max_passes is not None and len(passes) >= args.max_passes:
+        print(f"Stopping after the maximum of {args.max_passes} passes")
+        sys.exit(DONE)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,49 +4,197 @@
 import argparse
 import configparser
 import datetime
+import itertools
+import json
 import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
 
 import psycopg2
+import psycopg2.errorcodes
 import psycopg2.extras
+import zstandard
+
+from archive import Archive
+
+import resources
+import summary
 
 log = logging.getLogger('database')
 
+# Errors that leave the connection closed are worth retrying on a new one
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Workers that insert into the same new partition at once race to create it,
+# the loser fails with one of these once the winner committed
+PARTITION_RACE_ERRORS = (psycopg2.errorcodes.DUPLICATE_TABLE,
+                         psycopg2.errorcodes.UNIQUE_VIOLATION)
+
+# Columns that tables created before HARs could be archived lack
+ARCHIVE_COLUMNS = {'har_hash': "TEXT DEFAULT NULL",
+                   'har_size': "BIGINT DEFAULT NULL",
+                   'har_compressed_size': "BIGINT DEFAULT NULL"}
+
+# Columns that summary tables created before the completion policy lack
+COMPLETION_COLUMNS = {'completion_ms': "DOUBLE PRECISION DEFAULT NULL",
+                      'ended_by': "TEXT DEFAULT NULL"}
+
+# Suffixes of the tables that are derived from the HAR table
+DERIVED_TABLES = ('resources', 'summary', 'tasks')
+
 
 class Database:
-    def __init__(self, host, port, user, password, database, table):
+    def __init__(self, host, port, user, password, database, table, archive=None,
+                 partition=None, spill=None, retries=5, backoff=0.5, max_backoff=30.0,
+                 health_interval=60.0, check_schema=True):
         self._host = host
         self._port = port
         self._database = database
         self._user = user
         self._password = password
         self._table = table
-        self._connect()
+        # With an archive, HARs are stored compressed on disk and the table
+        # only keeps their hash and size
+        self._archive = Archive(archive) if archive else None
+        # New tables can be partitioned by 'experiment' or by insertion 'month'
+        if partition not in (None, 'experiment', 'month'):
+            raise ValueError(f"Partition must be 'experiment' or 'month', not '{partition}'")
+        self._partition = partition
+        self._partitions = set()
+        # Every thread gets its own connection and cursor, so that measurement
+        # workers never wait for each other
+        self._local = threading.local()
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._health_interval = health_interval
+        # HARs that cannot be written because the database is unreachable are
+        # appended to this file and replayed once it is back
+        self._spill = spill
+        self._spill_lock = threading.Lock()
+        self.spilled = 0
+        if spill:
+            self._recover_spill()
+        if check_schema:
+            self.check_schema()
+        self.replay_spill()
+
+    @property
+    def conn(self):
+        return getattr(self._local, 'conn', None)
+
+    @property
+    def cursor(self):
+        return getattr(self._local, 'cursor', None)
+
+    @property
+    def archive(self):
+        return self._archive
+
+    def _new_connection(self):
+        return psycopg2.connect(host=self._host,
+                                port=self._port,
+                                user=self._user,
+                                password=self._password,
+                                database=self._database)
 
     def _connect(self):
-        try:
-            self.conn = psycopg2.connect(host=self._host,
-                                         port=self._port,
-                                         user=self._user,
-                                         password=self._password,
-                                         database=self._database)
-            psycopg2.extras.register_uuid()
-        except Exception as e:
-            log.error(f"Error connecting to database: {e}")
+        conn = self._new_connection()
+        psycopg2.extras.register_uuid()
+        self._local.conn = conn
+        self._local.cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self._local.used = time.monotonic()
 
-        try:
-            self.cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        except Exception as e:
-            log.error(f"Error getting cursor from database: {e}")
+        with self._connections_lock:
+            # Forget the connections of threads that have finished
+            alive = {thread.ident for thread in threading.enumerate()}
+            for ident in set(self._connections) - alive:
+                self._connections.pop(ident).close()
+            self._connections[threading.get_ident()] = conn
+
+    def _disconnect(self):
+        conn = self.conn
+        self._local.conn = self._local.cursor = None
+        with self._connections_lock:
+            self._connections.pop(threading.get_ident(), None)
+        if conn is not None:
+            conn.close()
+
+    def _checkout(self):
+        # Connects this thread, and checks that a connection that has been
+        # idle for a while has not been dropped by the server in the meantime
+        if self.conn is None or self.conn.closed:
+            self._disconnect()
+            self._connect()
+        elif time.monotonic() - self._local.used > self._health_interval:
+            self.cursor.execute("SELECT 1")
+            self.conn.rollback()
+        self._local.used = time.monotonic()
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
 
-        self.create()
+    def _delay(self, attempt):
+        # Exponential backoff with jitter, so that workers do not reconnect in
+        # lockstep after the database restarts
+        delay = min(self._backoff * 2 ** attempt, self._max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _run(self, work):
+        # Runs work() and commits on the connection of this thread. Connection
+        # errors are retried on a new connection, other errors roll back.
+        for attempt in range(self._retries + 1):
+            try:
+                self._checkout()
+                work()
+                self.conn.commit()
+                return None
+            except TRANSIENT_ERRORS as e:
+                if self.conn is not None and not self.conn.closed \
+                        and not isinstance(e, psycopg2.InterfaceError):
+                    # The server rejected the command, the connection is fine
+                    log.error(f"Unable to execute database command {e}")
+                    self.conn.rollback()
+                    return e
+                rv = e
+                self._disconnect()
+                if attempt < self._retries:
+                    delay = self._delay(attempt)
+                    log.warning(f"Lost connection to database, reconnecting in "
+                                f"{delay:.1f}s: {e}")
+                    time.sleep(delay)
+            except Exception as e:
+                log.error(f"Unable to execute database command {e}")
+                if self.conn is not None and not self.conn.closed:
+                    self.conn.rollback()
+                return e
+        log.error(f"Unable to execute database command after {self._retries} "
+                  f"retries {rv}")
+        return rv
 
     def _table_exists(self):
-        self._execute_command(f"SELECT to_regclass('{self._table}')")
+        # The error if the database cannot be asked
+        rv = self._execute_command(f"SELECT to_regclass('{self._table}')")
+        if rv:
+            log.error(f"Error checking whether table '{self._table}' exists: {rv}")
+            return rv
         rv = self.cursor.fetchone()[0]
         return rv
 
     @staticmethod
-    def init_from_config_file(config_filename, section='postgresql'):
+    def init_from_config_file(config_filename, section='postgresql', table=None,
+                              check_schema=True):
         parser = configparser.ConfigParser()
         parser.read(config_filename)
 
@@ -60,28 +208,54 @@ class Database:
                         user=params['user'],
                         password=params['password'],
                         database=params['database'],
-                        table=params['table'])
+                        table=table or params['table'],
+                        archive=params.get('archive'),
+                        partition=params.get('partition'),
+                        spill=params.get('spill'),
+                        retries=int(params.get('retries', 5)),
+                        check_schema=check_schema)
 
     def _execute_command(self, cmd, format_tuple=None):
-        if self.conn.closed:
-            self._connect()
-
-        try:
+        def work():
             if format_tuple:
                 self.cursor.execute(cmd, format_tuple)
             else:
                 self.cursor.execute(cmd)
-            self.conn.commit()
-        except Exception as e:
-            log.error(f"Unable to execute database command {e}")
-            self.conn.commit()
-            return e
-        return None
+
+        return self._run(work)
+
+    def _execute_transaction(self, commands):
+        # Runs (command, arguments) pairs in a single transaction, a list of
+        # arguments is inserted as multiple rows with execute_values
+        def work():
+            for cmd, args in commands:
+                if isinstance(args, list):
+                    if args:
+                        psycopg2.extras.execute_values(self.cursor, cmd, args,
+                                                       page_size=1000)
+                elif args:
+                    self.cursor.execute(cmd, args)
+                else:
+                    self.cursor.execute(cmd)
+
+        return self._run(work)
 
     def create(self):
-        if self._table_exists():
+        exists = self._table_exists()
+        if isinstance(exists, Exception):
+            return exists
+        if exists:
             log.warning(f"Table '{self._table}' already exists, not recreating")
-            return
+            return None
+
+        primary_key = "PRIMARY KEY (har_uuid)"
+        partition_by = ""
+        if self._partition == 'experiment':
+            primary_key = "PRIMARY KEY (experiment, har_uuid)"
+            partition_by = "PARTITION BY LIST (experiment)"
+        elif self._partition == 'month':
+            primary_key = "PRIMARY KEY (insertion_time, har_uuid)"
+            partition_by = "PARTITION BY RANGE (insertion_time)"
 
         cmd = \
             f"""CREATE TABLE {self._table} (experiment UUID,
@@ -89,150 +263,1355 @@ class Database:
                                             browser TEXT,
                                             extensions TEXT,
                                             domain TEXT,
-                                            har_uuid UUID PRIMARY KEY,
+                                            har_uuid UUID,
                                             har JSONB,
-                                            har_error TEXT DEFAULT NULL)
+                                            har_error TEXT DEFAULT NULL,
+                                            har_hash TEXT DEFAULT NULL,
+                                            har_size BIGINT DEFAULT NULL,
+                                            har_compressed_size BIGINT DEFAULT NULL,
+                                            {primary_key})
+                {partition_by}
             """
 
-        rv = self._execute_command(cmd)
+        # The tables are new and empty, so nothing waits for their indexes
+        indexes = [(f"CREATE INDEX {name} ON {table} {columns}", None)
+                   for name, table, columns in self._indexes()]
+        rv = self._execute_transaction([(cmd, None)] + self._derived_table_commands() + indexes)
         if rv:
             log.error(f"Error creating table '{self._table}': error: {rv}")
         return rv
 
+    def _partitioning(self):
+        # 'experiment' or 'month' if the table is partitioned like that, None
+        # if it is not partitioned
+        cmd = \
+            f"""SELECT p.partstrat, a.attname
+                FROM pg_partitioned_table p
+                     JOIN pg_attribute a ON a.attrelid = p.partrelid
+                                        AND a.attnum = p.partattrs[0]
+                WHERE p.partrelid = %s::regclass
+            """
+        rv = self._execute_command(cmd, (self._table,))
+        if rv:
+            return rv
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return {('l', 'experiment'): 'experiment',
+                ('r', 'insertion_time'): 'month'}.get(tuple(row), f"{row[0]}:{row[1]}")
+
+    def _partitioning_mismatch(self, partitioning):
+        actual = f"partitioned by '{partitioning}'" if partitioning else "not partitioned"
+        expected = f"'{self._partition}'" if self._partition else "not set"
+        return f"Table '{self._table}' is {actual}, but partition is {expected}"
+
+    def _missing_columns(self):
+        # The columns every table lacks, as (table, column) pairs
+        expected = {self._table: ARCHIVE_COLUMNS,
+                    f"{self._table}_summary": COMPLETION_COLUMNS}
+        cmd = \
+            """SELECT table_name, column_name
+               FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = ANY(%s)
+            """
+        rv = self._execute_command(cmd, (list(expected),))
+        if rv:
+            return rv
+        columns = {tuple(row) for row in self.cursor.fetchall()}
+        tables = {table for table, _ in columns}
+        # A missing derived table is created with all its columns
+        return [(table, column) for table, table_columns in expected.items()
+                if table in tables for column in table_columns
+                if (table, column) not in columns]
+
+    def _missing_tables(self):
+        tables = [f"{self._table}_{suffix}" for suffix in DERIVED_TABLES]
+        rv = self._execute_command("SELECT t, to_regclass(t) FROM unnest(%s) AS t", (tables,))
+        if rv:
+            return rv
+        return [table for table, regclass in self.cursor.fetchall() if regclass is None]
+
+    def _index_states(self):
+        # Whether every index exists and is valid, None if it does not exist
+        names = [name for name, _, _ in self._indexes()]
+        cmd = \
+            """SELECT n.name, x.indisvalid
+               FROM unnest(%s) AS n(name) LEFT JOIN pg_index x
+                    ON x.indexrelid = to_regclass(n.name)
+            """
+        rv = self._execute_command(cmd, (names,))
+        if rv:
+            return rv
+        return dict(self.cursor.fetchall())
+
+    def check_schema(self):
+        # Creates the tables if they do not exist yet. An existing table is
+        # only checked, changing it would lock it while measurements write to
+        # it, so that is left to an explicit `database.py --migrate`.
+        exists = self._table_exists()
+        if isinstance(exists, Exception):
+            return exists
+        if not exists:
+            return self.create()
+
+        partitioning = self._partitioning()
+        if isinstance(partitioning, Exception):
+            return partitioning
+        if partitioning != self._partition:
+            raise ValueError(self._partitioning_mismatch(partitioning))
+
+        missing = []
+        for rv in (self._missing_columns(), self._missing_tables()):
+            if isinstance(rv, Exception):
+                return rv
+            missing += [".".join(item) if isinstance(item, tuple) else item
+                        for item in rv]
+        if missing:
+            raise ValueError(f"Table '{self._table}' lacks {', '.join(missing)}, "
+                             f"run database.py --migrate")
+
+        states = self._index_states()
+        if isinstance(states, Exception):
+            return states
+        unusable = [name for name, valid in states.items() if not valid]
+        if unusable:
+            log.warning(f"Indexes {', '.join(unusable)} are missing or invalid, "
+                        f"run database.py --migrate")
+        return None
+
+    def _execute_concurrently(self, cmd):
+        # CREATE and DROP INDEX CONCURRENTLY cannot run inside a transaction,
+        # so they get a connection of their own in autocommit mode
+        conn = self._new_connection()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(cmd)
+        except psycopg2.Error as e:
+            log.error(f"Unable to execute database command {e}")
+            return e
+        finally:
+            conn.close()
+        return None
+
+    def _attached_partitions(self, index):
+        # The partitions whose index is attached to a partitioned index
+        cmd = \
+            """SELECT t.relname
+               FROM pg_inherits i
+                    JOIN pg_index x ON x.indexrelid = i.inhrelid
+                    JOIN pg_class t ON t.oid = x.indrelid
+               WHERE i.inhparent = %s::regclass
+            """
+        rv = self._execute_command(cmd, (index,))
+        if rv:
+            return rv
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def _create_index(self, name, table, columns, valid):
+        # `valid` is None if the index does not exist, False if an earlier
+        # attempt left it invalid
+        if table != self._table or not self._partition:
+            if valid is False:
+                rv = self._execute_concurrently(f"DROP INDEX CONCURRENTLY {name}")
+                if rv:
+                    return rv
+            return self._execute_concurrently(
+                f"CREATE INDEX CONCURRENTLY {name} ON {table} {columns}")
+
+        # Partitioned tables cannot be indexed concurrently, so the index is
+        # created on the table alone and the index of every partition, built
+        # concurrently, is attached to it. It is valid once all of them are.
+        rv = self._execute_command(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {columns}")
+        if rv:
+            return rv
+        attached = self._attached_partitions(name)
+        if isinstance(attached, Exception):
+            return attached
+        partitions = self.partitions()
+        if isinstance(partitions, Exception):
+            return partitions
+        for partition in partitions:
+            if partition['name'] in attached:
+                continue
+            # Postgres truncates names beyond 63 characters
+            partition_index = f"{partition['name']}_{name[len(table) + 1:]}"[:63]
+            rv = self._execute_concurrently(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                                            f"{partition_index} ON {partition['name']} {columns}")
+            if rv:
+                return rv
+            rv = self._execute_command(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+            if rv:
+                return rv
+        return None
+
+    def migrate(self):
+        # Brings a table that an earlier version created up to date. Adding
+        # nullable columns and new tables only locks briefly, and indexes are
+        # built concurrently, so measurements can go on writing meanwhile.
+        exists = self._table_exists()
+        if isinstance(exists, Exception):
+            return exists
+        if not exists:
+            return self.create()
+
+        partitioning = self._partitioning()
+        if isinstance(partitioning, Exception):
+            return partitioning
+        if partitioning != self._partition:
+            # Changing the layout means copying the whole table
+            rv = ValueError(self._partitioning_mismatch(partitioning))
+            log.error(f"Error migrating table '{self._table}': error: {rv}")
+            return rv
+
+        missing = self._missing_columns()
+        if isinstance(missing, Exception):
+            return missing
+        commands = self._derived_table_commands()
+        for table, types in ((self._table, ARCHIVE_COLUMNS),
+                             (f"{self._table}_summary", COMPLETION_COLUMNS)):
+            columns = [column for missing_table, column in missing if missing_table == table]
+            if not columns:
+                continue
+            log.info(f"Adding columns {', '.join(columns)} to '{table}'")
+            columns = ", ".join(f"ADD COLUMN IF NOT EXISTS {column} {types[column]}"
+                                for column in columns)
+            commands.append((f"ALTER TABLE {table} {columns}", None))
+        rv = self._execute_transaction(commands)
+        if rv:
+            log.error(f"Error migrating table '{self._table}': error: {rv}")
+            return rv
+
+        states = self._index_states()
+        if isinstance(states, Exception):
+            return states
+        for name, table, columns in self._indexes():
+            if states[name]:
+                continue
+            log.info(f"Creating index '{name}' on '{table}'")
+            rv = self._create_index(name, table, columns, states[name])
+            if rv:
+                log.error(f"Error creating index '{name}': error: {rv}")
+                return rv
+        return None
+
+    def _indexes(self):
+        # The name, table and columns of every index. On a partitioned table,
+        # the indexes are created on every partition.
+        return [(f"{self._table}_experiment_idx", self._table,
+                 "(experiment, extensions, domain)"),
+                (f"{self._table}_domain_idx", self._table, "(domain, browser)"),
+                (f"{self._table}_resources_host_idx", f"{self._table}_resources", "(host)"),
+                (f"{self._table}_resources_registrable_domain_idx", f"{self._table}_resources",
+                 "(registrable_domain)"),
+                (f"{self._table}_summary_experiment_idx", f"{self._table}_summary",
+                 "(experiment, extensions, domain)"),
+                (f"{self._table}_summary_domain_idx", f"{self._table}_summary", "(domain)"),
+                (f"{self._table}_tasks_pending_idx", f"{self._table}_tasks",
+                 "(browser, position) WHERE state = 'pending'"),
+                (f"{self._table}_tasks_running_idx", f"{self._table}_tasks",
+                 "(leased_until) WHERE state = 'running'")]
+
+    def _partition_bounds(self, key):
+        # `key` is an experiment UUID or a date or datetime within the month
+        if self._partition == 'experiment':
+            experiment = uuid.UUID(str(key))
+            return f"{self._table}_{experiment.hex}", f"FOR VALUES IN ('{experiment}')"
+
+        if isinstance(key, str):
+            key = datetime.datetime.strptime(key[:7], "%Y-%m")
+        start = datetime.date(key.year, key.month, 1)
+        end = datetime.date(key.year + key.month // 12, key.month % 12 + 1, 1)
+        return f"{self._table}_{start:%Y%m}", f"FOR VALUES FROM ('{start}') TO ('{end}')"
+
+    def _partition_commands(self, rows):
+        # Creates the partitions that the rows are about to be inserted into
+        if not self._partition:
+            return [], set()
+
+        commands, names = [], set()
+        for row in rows:
+            key = row[0] if self._partition == 'experiment' else row[7]
+            name, bounds = self._partition_bounds(key)
+            if name in self._partitions or name in names:
+                continue
+            commands.append((f"CREATE TABLE IF NOT EXISTS {name} "
+                             f"PARTITION OF {self._table} {bounds}", None))
+            names.add(name)
+        return commands, names
+
+    def _create_partitions(self, commands):
+        # The partition exists once the winner of a race committed, so the
+        # loser finds it on the next attempt
+        for _ in range(self._retries + 1):
+            rv = self._execute_transaction(commands)
+            if getattr(rv, 'pgcode', None) not in PARTITION_RACE_ERRORS:
+                return rv
+            log.info(f"Partition was created concurrently, retrying: {rv}")
+        return rv
+
+    def partitions(self):
+        cmd = \
+            f"""SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bounds
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                ORDER BY c.relname
+            """
+        rv = self._execute_command(cmd, (self._table,))
+        if rv:
+            log.error(f"Error listing partitions of '{self._table}': {rv}")
+            return rv
+        return self.cursor.fetchall()
+
+    @staticmethod
+    def _check_identifier(name):
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+            raise ValueError(f"'{name}' is not a valid table name")
+
+    def attach_partition(self, name, key):
+        self._check_identifier(name)
+        _, bounds = self._partition_bounds(key)
+        rv = self._execute_command(f"ALTER TABLE {self._table} ATTACH PARTITION {name} {bounds}")
+        if rv:
+            log.error(f"Error attaching partition '{name}': {rv}")
+        return rv
+
+    def detach_partition(self, name):
+        self._check_identifier(name)
+        rv = self._execute_command(f"ALTER TABLE {self._table} DETACH PARTITION {name}")
+        if rv:
+            log.error(f"Error detaching partition '{name}': {rv}")
+            return rv
+        self._partitions.discard(name)
+        return None
+
+    def _copy_to_file(self, query, path):
+        def work():
+            with open(path, 'wb') as f:
+                compressor = zstandard.ZstdCompressor(level=9)
+                with compressor.stream_writer(f, closefd=False) as writer:
+                    self.cursor.copy_expert(f"COPY ({query}) TO STDOUT", writer)
+
+        return self._run(work)
+
+    def archive_partition(self, name, directory):
+        # Dumps a partition, and the resources and summaries of its HARs, into
+        # zstd-compressed COPY files and drops them from the database
+        self._check_identifier(name)
+        partitions = self.partitions()
+        if isinstance(partitions, Exception):
+            return partitions
+        if any(partition['name'] == name for partition in partitions):
+            rv = self.detach_partition(name)
+            if rv:
+                return rv
+
+        har_uuids = f"SELECT har_uuid FROM {name}"
+        dumps = [(name, f"SELECT * FROM {name}"),
+                 (f"{name}_resources", f"SELECT * FROM {self._table}_resources "
+                                       f"WHERE har_uuid IN ({har_uuids})"),
+                 (f"{name}_summary", f"SELECT * FROM {self._table}_summary "
+                                     f"WHERE har_uuid IN ({har_uuids})")]
+        for filename, query in dumps:
+            rv = self._copy_to_file(query, f"{directory}/{filename}.copy.zst")
+            if rv:
+                log.error(f"Error archiving partition '{name}': {rv}")
+                return rv
+
+        rv = self._execute_transaction([
+            (f"DELETE FROM {self._table}_resources WHERE har_uuid IN ({har_uuids})", None),
+            (f"DELETE FROM {self._table}_summary WHERE har_uuid IN ({har_uuids})", None),
+            (f"DROP TABLE {name}", None)])
+        if rv:
+            log.error(f"Error dropping archived partition '{name}': {rv}")
+        return rv
+
+    def _derived_table_commands(self):
+        # One row per HAR entry and one summary row per visit, so that analyses
+        # do not have to unpack the HAR documents over and over again
+        perf_events = "\n".join(f"{event.replace('-', '_')} DOUBLE PRECISION,"
+                                for event in summary.PERF_EVENTS)
+        timings = "\n".join(f"{timing}_time REAL," for timing in resources.TIMINGS)
+        return [
+            (f"""CREATE TABLE IF NOT EXISTS {self._table}_resources (
+                    har_uuid UUID NOT NULL,
+                    entry INTEGER NOT NULL,
+                    url TEXT,
+                    host TEXT,
+                    registrable_domain TEXT,
+                    mime_type TEXT,
+                    status INTEGER,
+                    transfer_size BIGINT,
+                    body_size BIGINT,
+                    time REAL,
+                    {timings}
+                    blocked BOOLEAN,
+                    PRIMARY KEY (har_uuid, entry))
+             """, None),
+            (f"""CREATE TABLE IF NOT EXISTS {self._table}_summary (
+                    experiment UUID,
+                    browser TEXT,
+                    extensions TEXT,
+                    domain TEXT,
+                    har_uuid UUID PRIMARY KEY,
+                    resources INTEGER,
+                    onload DOUBLE PRECISION,
+                    oncontentload DOUBLE PRECISION,
+                    transfer_size BIGINT,
+                    error BOOLEAN,
+                    completion_ms DOUBLE PRECISION,
+                    ended_by TEXT,
+                    {perf_events.rstrip(",")})
+             """, None),
+            # The work queue that measurement hosts claim domains from
+            (f"""CREATE TABLE IF NOT EXISTS {self._table}_tasks (
+                    task_id BIGSERIAL PRIMARY KEY,
+                    experiment UUID NOT NULL,
+                    browser TEXT NOT NULL,
+                    domain TEXT NOT NULL,
+                    configurations TEXT[] NOT NULL,
+                    position INTEGER NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    leased_until TIMESTAMPTZ,
+                    finished TIMESTAMPTZ,
+                    UNIQUE (experiment, browser, domain))
+             """, None)]
+
     def drop(self):
-        if not self._table_exists():
+        exists = self._table_exists()
+        if isinstance(exists, Exception):
+            return exists
+        if not exists:
             log.error(f"Table '{self._table}' does not exist")
-            return
+            return None
 
+        rv = self._execute_command(f"DROP TABLE IF EXISTS {self._table}_resources, "
+                                   f"{self._table}_summary, {self._table}_tasks")
+        if rv:
+            return rv
         rv = self._execute_command(f"DROP TABLE {self._table}")
         if rv:
             pass
         return rv
 
-    def insert(self, experiment, browser, extensions, domain,
-               har_uuid, har, har_error):
-        cmd = \
-            f"""INSERT INTO {self._table} (experiment,
-                                           insertion_time,
-                                           browser,
-                                           extensions,
-                                           domain,
-                                           har_uuid,
-                                           har,
-                                           har_error)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-        now = datetime.datetime.utcnow()
+    def _insert_columns(self):
+        return f"""INSERT INTO {self._table} (experiment,
+                                              insertion_time,
+                                              browser,
+                                              extensions,
+                                              domain,
+                                              har_uuid,
+                                              har,
+                                              har_error,
+                                              har_hash,
+                                              har_size,
+                                              har_compressed_size)
+                """
+
+    def _insert_row(self, experiment, browser, extensions, domain, har_uuid, har, har_error,
+                    insertion_time=None):
+        now = insertion_time or datetime.datetime.utcnow()
         har_uuid = psycopg2.extensions.adapt(har_uuid)
 
+        if har and self._archive:
+            return (experiment, now, browser, extensions, domain,
+                    har_uuid, None, None, *self._archive.put(har))
         if har:
-            tup = (experiment, now, browser, extensions, domain,
-                   har_uuid, psycopg2.extras.Json(har), None)
-        else:
-            tup = (experiment, now, browser, extensions, domain,
-                   har_uuid, None, har_error)
+            return (experiment, now, browser, extensions, domain,
+                    har_uuid, psycopg2.extras.Json(har), None, None, None, None)
+        return (experiment, now, browser, extensions, domain,
+                har_uuid, None, har_error, None, None, None)
+
+    def _insert_resources_command(self):
+        return f"""INSERT INTO {self._table}_resources ({", ".join(resources.COLUMNS)})
+                   VALUES %s
+                """
+
+    def _upsert_summary_command(self):
+        updates = ", ".join(f"{column} = EXCLUDED.{column}"
+                            for column in summary.COLUMNS if column != 'har_uuid')
+        return f"""INSERT INTO {self._table}_summary ({", ".join(summary.COLUMNS)})
+                   VALUES %s
+                   ON CONFLICT (har_uuid) DO UPDATE SET {updates}
+                """
+
+    def _insert_commands(self, rows):
+        # Every row is a tuple of the arguments to insert() followed by the
+        # insertion time. The HARs, their resources and their summaries are
+        # written in one transaction.
+        tups, resource_tups, summary_tups = [], [], []
+        for row in rows:
+            har_resources = resources.har_resources(row[4], row[5])
+            tups.append(self._insert_row(*row))
+            resource_tups += har_resources
+            summary_tups.append(summary.har_summary(*row[:7], har_resources))
+
+        return [(f"{self._insert_columns()} VALUES %s", tups),
+                (self._insert_resources_command(), resource_tups),
+                (self._upsert_summary_command(), summary_tups)]
 
-        rv = self._execute_command(cmd, tup)
+    def _write_rows(self, rows):
+        # Every row is a tuple of the arguments to insert(), optionally followed
+        # by the insertion time. The partitions the rows go to are created in a
+        # transaction of their own first, so that losing a race to create one
+        # does not roll back the HARs.
+        rows = [row if len(row) > 7 else (*row, datetime.datetime.utcnow())
+                for row in rows]
+        commands, partitions = self._partition_commands(rows)
+        if commands:
+            rv = self._create_partitions(commands)
+            if rv:
+                return rv
+            self._partitions |= partitions
+        return self._execute_transaction(self._insert_commands(rows))
+
+    def insert(self, experiment, browser, extensions, domain,
+               har_uuid, har, har_error):
+        rv = self._write_rows(
+            [(experiment, browser, extensions, domain, har_uuid, har, har_error)])
+        # Without a connection, retrying is over and the HAR would be lost
+        if rv and self.conn is None and self._spill_rows(
+                [(experiment, browser, extensions, domain, har_uuid, har, har_error)]):
+            return None
         if rv:
             log.error(f"Error inserting HAR into database: {rv}")
+            return rv
+        self._replay_after_spill()
         return rv
 
-    def get_hars(self, extensions, domains):
-        domains = tuple(domains)
-        cmd = \
-            f"""SELECT *
-                FROM {self._table}
-                WHERE extensions = %s AND domain IN %s
-            """
+    def insert_many(self, rows):
+        # Every row is a tuple of the arguments to insert() followed by the
+        # time it was queued at
+        rv = self._write_rows(rows)
+        if rv and self.conn is None and self._spill_rows(rows):
+            return None
+        if rv:
+            log.error(f"Error inserting {len(rows)} HARs into database: {rv}")
+            return rv
+        self._replay_after_spill()
+        return rv
+
+    @staticmethod
+    def _spill_line(row):
+        experiment, browser, extensions, domain, har_uuid, har, har_error, *rest = row
+        insertion_time = rest[0] if rest else datetime.datetime.utcnow()
+        return json.dumps({'experiment': str(experiment),
+                           'insertion_time': insertion_time.isoformat(),
+                           'browser': browser,
+                           'extensions': extensions,
+                           'domain': domain,
+                           'har_uuid': str(har_uuid),
+                           'har': har,
+                           'har_error': har_error}) + "\n"
+
+    @staticmethod
+    def _spilled_row(line):
+        row = json.loads(line)
+        return (uuid.UUID(row['experiment']),
+                row['browser'],
+                row['extensions'],
+                row['domain'],
+                uuid.UUID(row['har_uuid']),
+                row['har'],
+                row['har_error'],
+                datetime.datetime.fromisoformat(row['insertion_time']))
 
-        rv = self._execute_command(cmd, (recursive, dns_type, domains))
+    def _append_spill(self, path, lines):
+        with self._spill_lock, open(path, 'a') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spill_rows(self, rows):
+        # Appends rows that could not be written to the spill file, one JSON
+        # document per line, and returns whether they were spilled
+        if not self._spill:
+            return False
+
+        self._append_spill(self._spill, [self._spill_line(row) for row in rows])
+        self.spilled += len(rows)
+        log.warning(f"Spilled {len(rows)} HARs to '{self._spill}'")
+        return True
+
+    def _replay_after_spill(self):
+        # A successful write means that the database is back, so HARs spilled
+        # in the meantime are written now
+        if self._spill and os.path.exists(self._spill) \
+                and not getattr(self._local, 'replaying', False):
+            self.replay_spill()
+
+    def _recover_spill(self):
+        # A replay that was interrupted leaves its file behind, its HARs go
+        # back into the spill file
+        replaying = f"{self._spill}.replaying"
+        if os.path.exists(replaying):
+            if os.path.exists(self._spill):
+                with open(self._spill) as f:
+                    self._append_spill(replaying, f)
+            os.replace(replaying, self._spill)
+
+    def _replay_lines(self, lines):
+        # Writes spilled HARs, a batch that the database rejects is split in
+        # halves so that only the offending HARs are moved to the '.rejected'
+        # file. Returns the number of HARs written, and whether the database is
+        # gone again, in which case the HARs that were not written are spilled.
+        written, batches = 0, [lines]
+        while batches:
+            lines = batches.pop()
+            spilled = self.spilled
+            rv = self.insert_many([self._spilled_row(line) for line in lines])
+            if self.spilled > spilled:
+                for rest in batches:
+                    self._append_spill(self._spill, rest)
+                return written, True
+            if not rv:
+                written += len(lines)
+            elif len(lines) > 1:
+                middle = len(lines) // 2
+                batches += [lines[middle:], lines[:middle]]
+            elif getattr(rv, 'pgcode', None) == psycopg2.errorcodes.UNIQUE_VIOLATION:
+                # Committed before the connection dropped, and spilled anyway
+                log.info(f"Spilled HAR '{self._spilled_row(lines[0])[4]}' is already written")
+            else:
+                self._append_spill(f"{self._spill}.rejected", lines)
+        return written, False
+
+    def replay_spill(self, batch_size=100):
+        # The spill file is renamed first, so that concurrent spills go to a
+        # new file and only one thread replays at a time. HARs that the
+        # database rejects are moved to a '.rejected' file for inspection.
+        if not self._spill:
+            return 0
+
+        replaying = f"{self._spill}.replaying"
+        with self._spill_lock:
+            if os.path.exists(replaying) or not os.path.exists(self._spill):
+                return 0
+            os.replace(self._spill, replaying)
+
+        self._local.replaying = True
+        replayed = 0
+        try:
+            with open(replaying) as f:
+                for lines in iter(lambda: list(itertools.islice(f, batch_size)), []):
+                    written, gone = self._replay_lines(lines)
+                    replayed += written
+                    if gone:
+                        # The database is gone again, keep the rest for later
+                        self._append_spill(self._spill, f)
+                        break
+            os.unlink(replaying)
+        finally:
+            self._local.replaying = False
+
+        log.info(f"Replayed {replayed} spilled HARs from '{self._spill}'")
+        return replayed
+
+    @staticmethod
+    def _column_batches(rows, columns, batch_size):
+        # Turns rows into dictionaries of columns with up to batch_size values
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield {column: [row[i] for row in batch] for i, column in enumerate(columns)}
+                batch = []
+        if batch:
+            yield {column: [row[i] for row in batch] for i, column in enumerate(columns)}
+
+    def _stream(self, cmd, format_tuple=None, itersize=1000, row_type='dict',
+                batch_size=None):
+        # Streams rows through a server-side cursor on a dedicated connection,
+        # so that only itersize rows are in client memory at a time and the
+        # cursor survives the commits of other commands. Rows are dictionaries
+        # or tuples, or dictionaries of column batches if batch_size is given.
+        if row_type not in ('dict', 'tuple'):
+            raise ValueError(f"Row type must be 'dict' or 'tuple', not '{row_type}'")
+
+        conn = self._new_connection()
+        try:
+            cursor_factory = psycopg2.extras.DictCursor \
+                if row_type == 'dict' and not batch_size else None
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}",
+                             cursor_factory=cursor_factory) as cursor:
+                cursor.itersize = itersize
+                cursor.execute(cmd, format_tuple)
+                if batch_size:
+                    # The description is only available after the first fetch
+                    rows = iter(cursor)
+                    first = next(rows, None)
+                    if first is None:
+                        return
+                    columns = [column[0] for column in cursor.description]
+                    yield from self._column_batches(
+                        itertools.chain([first], rows), columns, batch_size)
+                else:
+                    yield from cursor
+        finally:
+            conn.close()
+
+    def _query(self, cmd, format_tuple, description, stream=False, **stream_options):
+        if stream:
+            return self._stream(cmd, format_tuple, **stream_options)
+
+        rv = self._execute_command(cmd, format_tuple)
         if rv:
-            err = 'Error getting HARs from database, error: {}'
-            print(err.format(rv))
+            log.error(f"Error getting {description}: {rv}")
             return rv
+
         rv = self.cursor.fetchall()
         return rv
 
-    def get_resources(self, domains, experiments=None):
+    @staticmethod
+    def _filters(**filters):
+        # Builds a WHERE clause from columns and the values they may take
+        clauses, format_tuple = [], ()
+        for column, values in filters.items():
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = (values,)
+            values = tuple(values)
+            # No value can match an empty list, and IN () is not valid SQL
+            if not values:
+                clauses.append("FALSE")
+                continue
+            clauses.append(f"{column.replace('__', '.')} IN %s")
+            format_tuple += (values,)
+        if not clauses:
+            return "", None
+        return "WHERE " + " AND ".join(clauses), format_tuple
+
+    def iter_hars(self, extensions=None, domains=None, experiments=None, browsers=None,
+                  har_paths=None, row_type='dict', batch_size=None, itersize=100):
+        # Streams visits with either their whole HAR or, if har_paths maps
+        # names to paths such as ('har', 'pages', '0', 'pageTimings', 'onLoad'),
+        # only those parts of it, extracted on the server
+        columns = ['experiment', 'insertion_time', 'browser', 'extensions', 'domain',
+                   'har_uuid', 'har_error']
+        projections, format_tuple = [], ()
+        if har_paths:
+            for name, path in har_paths.items():
+                self._check_identifier(name)
+                projections.append(f"jsonb_extract_path(har, VARIADIC %s) AS {name}")
+                format_tuple += ([str(key) for key in path],)
+            har_columns = list(har_paths)
+        else:
+            projections.append("har")
+            har_columns = ['har']
+
+        where, filter_tuple = self._filters(extensions=extensions, domain=domains,
+                                            experiment=experiments, browser=browsers)
         cmd = \
-            f"""SELECT experiment, extensions, domain, har_uuid
-                        (jsonb_extract_path(
-                            jsonb_array_elements(
-                                jsonb_extract_path(har, 'entries')),
-                            'request')->>'url') as url
+            f"""SELECT {", ".join(columns + projections)}, har_hash
                 FROM {self._table}
-                WHERE domain IN %s
+                {where}
             """
+        rows = self._stream(cmd, format_tuple + (filter_tuple or ()), itersize, 'tuple')
+        columns += har_columns
 
-        domains = tuple(domains)
-        if experiments:
-            experiments = tuple(experiments)
-            cmd = f"{cmd} AND experiments IN %s"
-            rv = self._execute_command(cmd, (domains, experiments))
-        else:
-            rv = self._execute_command(cmd, (domains,))
+        def resolve(rows):
+            for *row, har_hash in rows:
+                # Archived HARs are only in the archive, so we extract the
+                # requested parts on the client instead
+                if har_hash and self._archive and all(v is None for v in row[7:]):
+                    har = self._archive.get(har_hash)
+                    if har_paths:
+                        row[7:] = [self._extract_path(har, path)
+                                   for path in har_paths.values()]
+                    else:
+                        row[7] = har
+                yield row
+
+        if batch_size:
+            return self._column_batches(resolve(rows), columns, batch_size)
+        if row_type == 'tuple':
+            return (tuple(row) for row in resolve(rows))
+        return (dict(zip(columns, row)) for row in resolve(rows))
+
+    @staticmethod
+    def _extract_path(document, path):
+        for key in path:
+            try:
+                document = document[int(key) if isinstance(document, list) else key]
+            except (KeyError, IndexError, ValueError, TypeError):
+                return None
+        return document
+
+    def get_hars(self, extensions, domains, experiments=None, stream=False, **stream_options):
+        rows = self.iter_hars(extensions=extensions, domains=domains,
+                              experiments=experiments, **stream_options)
+        if stream:
+            return rows
+        return list(rows)
 
+    def get_resources(self, domains, experiments=None, **stream_options):
+        where, format_tuple = self._filters(h__domain=domains, h__experiment=experiments)
+        cmd = \
+            f"""SELECT h.experiment, h.extensions, h.domain, r.har_uuid, r.url
+                FROM {self._table}_resources r JOIN {self._table} h USING (har_uuid)
+                {where}
+            """
+
+        return self._query(cmd, format_tuple, "resources URLs", **stream_options)
+
+    def get_hosts(self, domains, experiments=None, **stream_options):
+        where, format_tuple = self._filters(h__domain=domains, h__experiment=experiments)
+        cmd = \
+            f"""SELECT h.experiment, h.extensions, h.domain, r.har_uuid,
+                       r.host, r.registrable_domain,
+                       count(*) as requests,
+                       count(*) FILTER (WHERE r.blocked) as blocked,
+                       sum(r.transfer_size) as transfer_size
+                FROM {self._table}_resources r JOIN {self._table} h USING (har_uuid)
+                {where}
+                GROUP BY h.experiment, h.extensions, h.domain, r.har_uuid,
+                         r.host, r.registrable_domain
+            """
+
+        return self._query(cmd, format_tuple, "hosts", **stream_options)
+
+    def get_host_visits(self, hosts, experiments=None, **stream_options):
+        where, format_tuple = self._filters(r__host=hosts, h__experiment=experiments)
+        cmd = \
+            f"""SELECT h.experiment, h.extensions, h.domain, r.har_uuid, r.host,
+                       count(*) as requests,
+                       count(*) FILTER (WHERE r.blocked) as blocked
+                FROM {self._table}_resources r JOIN {self._table} h USING (har_uuid)
+                {where}
+                GROUP BY h.experiment, h.extensions, h.domain, r.har_uuid, r.host
+            """
+
+        return self._query(cmd, format_tuple, "visits for hosts", **stream_options)
+
+    def _har_batches(self, cmd, format_tuple=None, batch_size=100):
+        # `cmd` selects the UUIDs of the HARs to process, which are then
+        # fetched in batches so that only a few HARs are in memory at a time
+        rv = self._execute_command(cmd, format_tuple)
         if rv:
-            log.error(f"Error getting resources URLs: {rv}")
-            return rv
+            log.error(f"Error getting HARs to process: {rv}")
+            raise rv
+        har_uuids = [row[0] for row in self.cursor.fetchall()]
+        log.info(f"Processing {len(har_uuids)} HARs")
 
-        rv = self.cursor.fetchall()
-        return rv
+        cmd = \
+            f"""SELECT experiment, browser, extensions, domain, har_uuid, har, har_error,
+                       har_hash
+                FROM {self._table}
+                WHERE har_uuid IN %s
+            """
+        for start in range(0, len(har_uuids), batch_size):
+            rv = self._execute_command(cmd, (tuple(har_uuids[start:start + batch_size]),))
+            if rv:
+                log.error(f"Error getting HARs to process: {rv}")
+                raise rv
 
-    def get_resource_counts(self, experiments=None):
+            rows = []
+            for row in self.cursor.fetchall():
+                *row, har_hash = row
+                if row[5] is None and har_hash and self._archive:
+                    row[5] = self._archive.get(har_hash)
+                rows.append(tuple(row))
+            yield rows
+            log.info(f"Processed {min(start + batch_size, len(har_uuids))} "
+                     f"of {len(har_uuids)} HARs")
+
+    def backfill_resources(self, batch_size=100):
+        # Only HARs that have no resources yet, so the backfill can be resumed
         cmd = \
-            f"""SELECT experiment, extensions, domain, har_uuid,
-                    jsonb_array_length(jsonb_extract_path(har, 'entries')) as resources,
-                    (jsonb_extract_path(har, 'pages', '0', 'pageTimings')->>'onLoad')::float
-                        as pageload
-            FROM {self._table}
+            f"""SELECT h.har_uuid
+                FROM {self._table} h
+                WHERE (h.har IS NOT NULL OR h.har_hash IS NOT NULL) AND NOT EXISTS (
+                    SELECT 1 FROM {self._table}_resources r WHERE r.har_uuid = h.har_uuid)
             """
+        try:
+            for rows in self._har_batches(cmd, batch_size=batch_size):
+                resource_tups = [resource
+                                 for row in rows
+                                 for resource in resources.har_resources(row[4], row[5])]
+                rv = self._execute_transaction([(self._insert_resources_command(),
+                                                 resource_tups)])
+                if rv:
+                    log.error(f"Error backfilling resources: {rv}")
+                    return rv
+        except psycopg2.Error as e:
+            return e
+        return None
 
+    def rebuild_summary(self, experiments=None, batch_size=100):
+        cmd = f"SELECT har_uuid FROM {self._table}"
+        format_tuple = None
         if experiments:
-            experiments = tuple(experiments)
-            cmd = f"{cmd} WHERE experiments IN %s"
-            rv = self._execute_command(cmd, (experiments, ))
-        else:
-            rv = self._execute_command(cmd)
+            cmd = f"{cmd} WHERE experiment IN %s"
+            format_tuple = (tuple(experiments),)
 
+        try:
+            for rows in self._har_batches(cmd, format_tuple, batch_size):
+                summary_tups = [summary.har_summary(*row) for row in rows]
+                rv = self._execute_transaction([(self._upsert_summary_command(),
+                                                 summary_tups)])
+                if rv:
+                    log.error(f"Error rebuilding summary: {rv}")
+                    return rv
+        except psycopg2.Error as e:
+            return e
+        return None
+
+    def _har_uuid_time_range(self, har_uuid):
+        # HAR UUIDs are version 1 UUIDs that are generated right before the
+        # insertion, so their timestamp lets us prune month partitions
+        har_uuid = uuid.UUID(str(har_uuid))
+        if har_uuid.version != 1:
+            return None
+        created = datetime.datetime(1582, 10, 15) + \
+            datetime.timedelta(microseconds=har_uuid.time // 10)
+        margin = datetime.timedelta(days=1)
+        return created - margin, created + margin
+
+    def fetch_har(self, har_uuid, experiment=None):
+        # Returns the HAR from the table or, if it has been archived, reads and
+        # decompresses it from the archive
+        cmd = f"SELECT har, har_hash FROM {self._table} WHERE har_uuid = %s"
+        format_tuple = (har_uuid,)
+        if experiment:
+            cmd = f"{cmd} AND experiment = %s"
+            format_tuple += (experiment,)
+        time_range = self._har_uuid_time_range(har_uuid)
+        if self._partition == 'month' and time_range:
+            cmd = f"{cmd} AND insertion_time BETWEEN %s AND %s"
+            format_tuple += time_range
+        rv = self._execute_command(cmd, format_tuple)
         if rv:
-            log.error(f"Error getting resource counts: {rv}")
+            log.error(f"Error fetching HAR '{har_uuid}': {rv}")
+            return None
+
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        if row['har'] is not None or row['har_hash'] is None:
+            return row['har']
+        if not self._archive:
+            raise ValueError(f"HAR '{har_uuid}' is archived, but no archive is configured")
+        return self._archive.get(row['har_hash'])
+
+    def migrate_to_archive(self, batch_size=100):
+        if not self._archive:
+            raise ValueError("No archive is configured")
+
+        cmd = f"SELECT har_uuid FROM {self._table} WHERE har IS NOT NULL"
+        update = \
+            f"""UPDATE {self._table}
+                SET har = NULL, har_hash = %s, har_size = %s, har_compressed_size = %s
+                WHERE har_uuid = %s
+            """
+        try:
+            for rows in self._har_batches(cmd, batch_size=batch_size):
+                commands = []
+                for row in rows:
+                    digest, size, compressed_size = self._archive.put(row[5])
+                    # Never drop a HAR from the table before it can be read back
+                    if self._archive.get(digest) != row[5]:
+                        raise ValueError(f"HAR '{row[4]}' does not match its archived copy")
+                    commands.append((update, (digest, size, compressed_size, row[4])))
+
+                rv = self._execute_transaction(commands)
+                if rv:
+                    log.error(f"Error migrating HARs to the archive: {rv}")
+                    return rv
+        except (psycopg2.Error, ValueError) as e:
+            log.error(f"Error migrating HARs to the archive: {e}")
+            return e
+        return None
+
+    def archive_report(self, sample_size=100):
+        if not self._archive:
+            raise ValueError("No archive is configured")
+
+        cmd = \
+            f"""SELECT count(*), sum(har_size)::bigint, sum(har_compressed_size)::bigint
+                FROM {self._table}
+                WHERE har_hash IS NOT NULL
+            """
+        rv = self._execute_command(cmd)
+        if rv:
+            log.error(f"Error getting archive sizes: {rv}")
             return rv
+        count, size, compressed_size = self.cursor.fetchone()
 
-        rv = self.cursor.fetchall()
-        return rv
+        cmd = f"SELECT har_hash FROM {self._table} WHERE har_hash IS NOT NULL"
+        rv = self._execute_command(cmd)
+        if rv:
+            log.error(f"Error getting archived HARs: {rv}")
+            return rv
+        digests = [row[0] for row in self.cursor.fetchall()]
 
-    def get_pageloads(self, domains, experiments=None):
+        read_times = []
+        for digest in random.sample(digests, min(sample_size, len(digests))):
+            started = time.perf_counter()
+            self._archive.get(digest)
+            read_times.append(time.perf_counter() - started)
+
+        return {'hars': count,
+                'size': size,
+                'compressed_size': compressed_size,
+                'compression_ratio': size / compressed_size if compressed_size else None,
+                'sampled_reads': len(read_times),
+                'mean_read_time': sum(read_times) / len(read_times) if read_times else None,
+                'max_read_time': max(read_times) if read_times else None}
+
+    def get_completed_visits(self, experiment, domain=None):
+        # A single lookup on the experiment index, which covers the extensions
+        # and domain of every visit
         cmd = \
-            f"""SELECT experiment, extensions, domain, har_uuid,
-                       jsonb_extract_path(har, 'pages', '0', 'pageTimings')->>'onLoad' as pageload
+            f"""SELECT DISTINCT extensions, domain
                 FROM {self._table}
-                WHERE domain IN %s
+                WHERE experiment = %s {"AND domain = %s" if domain else ""}
             """
 
-        domains = tuple(domains)
-        if experiments:
-            experiments = tuple(experiments)
-            cmd = f"{cmd} AND experiments IN %s"
-            rv = self._execute_command(cmd, (domains, experiments))
-        else:
-            rv = self._execute_command(cmd, (domains,))
+        rv = self._query(cmd, (experiment, domain) if domain else (experiment,),
+                         "completed visits")
+        if isinstance(rv, Exception):
+            return rv
+        return {(row['extensions'], row['domain']) for row in rv}
+
+    def get_known_hosts(self, domain):
+        # The hosts that previous visits to a domain requested resources from
+        cmd = \
+            f"""SELECT DISTINCT r.host
+                FROM {self._table}_summary s JOIN {self._table}_resources r USING (har_uuid)
+                WHERE s.domain = %s AND r.host IS NOT NULL
+            """
+
+        rv = self._query(cmd, (domain,), "known hosts")
+        if isinstance(rv, Exception):
+            return rv
+        return {row['host'] for row in rv}
 
+    def get_resource_counts(self, experiments=None, **stream_options):
+        where, format_tuple = self._filters(experiment=experiments)
+        cmd = \
+            f"""SELECT experiment, extensions, domain, har_uuid, resources,
+                       onload as pageload
+                FROM {self._table}_summary
+                {where}
+            """
+
+        return self._query(cmd, format_tuple, "resource counts", **stream_options)
+
+    def get_pageloads(self, domains, experiments=None, **stream_options):
+        where, format_tuple = self._filters(domain=domains, experiment=experiments)
+        cmd = \
+            f"""SELECT experiment, extensions, domain, har_uuid, onload as pageload
+                FROM {self._table}_summary
+                {where}
+            """
+
+        return self._query(cmd, format_tuple, "pageloads", **stream_options)
+
+    def get_pass_results(self, experiments, **stream_options):
+        # The outcome of every visit of a series of passes. Visits that the
+        # completion policy ended without a load event count as done when it
+        # ended them.
+        where, format_tuple = self._filters(experiment=experiments)
+        cmd = \
+            f"""SELECT experiment, extensions, domain,
+                       COALESCE(onload, completion_ms) AS onload, resources, error
+                FROM {self._table}_summary
+                {where}
+            """
+
+        return self._query(cmd, format_tuple, "pass results", **stream_options)
+
+    def get_domain_history(self, browser, domains=None, failed_onload=None):
+        # How the visits of all previous experiments to every domain went, as
+        # a dict by domain. The median is of the visits with an onLoad. The
+        # 90th percentile counts failed visits as taking failed_onload, their
+        # timeout, or leaves them out without it. Visits that the completion
+        # policy ended without a load event count as loaded when it ended them.
+        where, format_tuple = self._filters(browser=browser, domain=domains)
+        cmd = \
+            f"""SELECT domain,
+                       count(*) AS visits,
+                       avg(error::int)::float AS error_rate,
+                       percentile_cont(0.5) WITHIN GROUP (
+                           ORDER BY COALESCE(onload, completion_ms)) AS median_onload,
+                       percentile_cont(0.9) WITHIN GROUP (
+                           ORDER BY CASE WHEN error OR COALESCE(onload, completion_ms) IS NULL
+                                         THEN %s::float
+                                         ELSE COALESCE(onload, completion_ms) END) AS p90_onload,
+                       avg(transfer_size)::float AS mean_transfer_size
+                FROM {self._table}_summary
+                {where}
+                GROUP BY domain
+            """
+
+        rv = self._query(cmd, (failed_onload, *(format_tuple or ())), "domain history")
+        if isinstance(rv, Exception):
+            return rv
+        return {row['domain']: dict(row) for row in rv}
+
+    def enqueue(self, plan):
+        # Adds one task per domain of a plan, the configurations of a domain
+        # are visited in order by whichever host claims it
+        tups = [(plan['experiment'], plan['browser'], visit['domain'],
+                 visit['configurations'], position)
+                for position, visit in enumerate(plan['visits'])]
+        cmd = \
+            f"""INSERT INTO {self._table}_tasks (experiment, browser, domain,
+                                                 configurations, position)
+                VALUES %s
+                ON CONFLICT (experiment, browser, domain) DO NOTHING
+            """
+        rv = self._execute_transaction([(cmd, tups)])
         if rv:
-            log.error(f"Error getting pageloads: {rv}")
+            log.error(f"Error enqueueing experiment '{plan['experiment']}': {rv}")
+        return rv
+
+    def requeue_expired_tasks(self, max_attempts=3):
+        # Tasks whose worker stopped renewing its lease go back to the queue,
+        # or are given up on after too many attempts
+        # RETURNING only sees the new row, the worker that lost the lease comes
+        # from the rows locked by the subquery
+        cmd = \
+            f"""UPDATE {self._table}_tasks t
+                SET state = CASE WHEN t.attempts >= %s THEN 'failed' ELSE 'pending' END,
+                    worker = NULL,
+                    leased_until = NULL
+                FROM (SELECT task_id, worker
+                      FROM {self._table}_tasks
+                      WHERE state = 'running' AND leased_until < now()
+                      FOR UPDATE SKIP LOCKED) old
+                WHERE t.task_id = old.task_id
+                RETURNING t.task_id, t.domain, old.worker, t.state
+            """
+        rv = self._query(cmd, (max_attempts,), "expired tasks")
+        if isinstance(rv, Exception):
             return rv
+        for row in rv:
+            log.warning(f"Lease of '{row['worker']}' on task {row['task_id']} for "
+                        f"'{row['domain']}' expired, task is {row['state']}")
+        return rv
 
-        rv = self.cursor.fetchall()
+    def claim_task(self, browser, worker, lease, max_attempts=3):
+        # SKIP LOCKED lets any number of hosts claim tasks concurrently
+        # without waiting for each other or claiming the same task twice
+        rv = self.requeue_expired_tasks(max_attempts)
+        if isinstance(rv, Exception):
+            return rv
+
+        cmd = \
+            f"""UPDATE {self._table}_tasks
+                SET state = 'running',
+                    worker = %s,
+                    attempts = attempts + 1,
+                    leased_until = now() + %s * interval '1 second'
+                WHERE task_id = (SELECT task_id
+                                 FROM {self._table}_tasks
+                                 WHERE state = 'pending' AND browser = %s
+                                 ORDER BY position, task_id
+                                 LIMIT 1
+                                 FOR UPDATE SKIP LOCKED)
+                RETURNING task_id, experiment, browser, domain, configurations
+            """
+        rv = self._query(cmd, (worker, lease, browser), "task")
+        if isinstance(rv, Exception):
+            return rv
+        return rv[0] if rv else None
+
+    def renew_leases(self, worker, lease):
+        # The heartbeat of a worker, renews the leases of all of its tasks
+        cmd = \
+            f"""UPDATE {self._table}_tasks
+                SET leased_until = now() + %s * interval '1 second'
+                WHERE state = 'running' AND worker = %s
+            """
+        rv = self._execute_command(cmd, (lease, worker))
+        if rv:
+            log.error(f"Error renewing leases of '{worker}': {rv}")
         return rv
 
+    def release_task(self, task_id, worker, max_attempts=3):
+        # Puts a task that its worker could not finish back into the queue
+        cmd = \
+            f"""UPDATE {self._table}_tasks
+                SET state = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                    worker = NULL,
+                    leased_until = NULL
+                WHERE task_id = %s AND worker = %s AND state = 'running'
+            """
+        rv = self._execute_command(cmd, (max_attempts, task_id, worker))
+        if rv:
+            log.error(f"Error releasing task {task_id}: {rv}")
+        return rv
+
+    def complete_task(self, task_id, worker):
+        # Only completes the task if the lease was not lost in the meantime
+        cmd = \
+            f"""UPDATE {self._table}_tasks
+                SET state = 'done', leased_until = NULL, finished = now()
+                WHERE task_id = %s AND worker = %s AND state = 'running'
+            """
+        rv = self._execute_command(cmd, (task_id, worker))
+        if rv:
+            log.error(f"Error completing task {task_id}: {rv}")
+            return rv
+        if not self.cursor.rowcount:
+            log.warning(f"Task {task_id} was requeued before '{worker}' completed it")
+        return None
+
+    def queue_status(self, experiment=None, browser=None):
+        where, format_tuple = self._filters(experiment=[experiment] if experiment else None,
+                                            browser=browser)
+        cmd = \
+            f"""SELECT state, count(*) AS tasks
+                FROM {self._table}_tasks
+                {where}
+                GROUP BY state
+            """
+        rv = self._query(cmd, format_tuple, "queue status")
+        if isinstance(rv, Exception):
+            return rv
+        return {row['state']: row['tasks'] for row in rv}
+
+
+# Buffers HARs on a bounded queue and writes them to the database in batches
+# from a background thread, so measurements do not wait on a round-trip to the
+# database for every visit. A batch that the database rejects is split in
+# halves until the offending rows are isolated and reported as lost. A batch
+# that cannot be written because the database is unreachable is spilled if the
+# database has a spill file, and lost otherwise.
+class BulkWriter(threading.Thread):
+    _STOP = object()
+
+    def __init__(self, database, batch_size=100, flush_interval=5.0, max_queue=1000):
+        super().__init__(name='bulk-writer', daemon=True)
+        self._database = database
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+
+        self.written = 0
+        self.lost = 0
+        self.flushes = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {'queue_depth': self.queue_depth,
+                'written': self.written,
+                'lost': self.lost,
+                'flushes': self.flushes,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency,
+                'spilled': self._database.spilled}
+
+    def insert(self, experiment, browser, extensions, domain,
+               har_uuid, har, har_error):
+        # Blocks while the queue is full, which slows down the measurements
+        # instead of growing the buffer without bound
+        self._queue.put((experiment, browser, extensions, domain,
+                         har_uuid, har, har_error, datetime.datetime.utcnow()))
+        return None
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self.join()
+        log.info(f"Bulk writer stopped: {self.stats()}")
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self._batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self._flush_interval
+
+    def _flush(self, batch):
+        if not batch:
+            return
+
+        started = time.monotonic()
+        self._write(batch)
+        self.last_flush_latency = time.monotonic() - started
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.flushes += 1
+        log.debug(f"Flushed {len(batch)} HARs in {self.last_flush_latency:.3f}s, "
+                  f"{self.queue_depth} queued")
+
+    def _write(self, batch):
+        rv = self._database.insert_many(batch)
+        if rv is None:
+            self.written += len(batch)
+            return
+
+        # Database._run has already retried on new connections, and splitting
+        # the batch would only retry every half of it again
+        if self._database.conn is None:
+            self.lost += len(batch)
+            log.error(f"Giving up on {len(batch)} HARs, the database is unreachable: {rv}")
+            return
+
+        # Bad data stays bad, so the rows it is in are isolated and dropped
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            self._write(batch[:middle])
+            self._write(batch[middle:])
+            return
+
+        self.lost += 1
+        log.error(f"Giving up on HAR '{batch[0][4]}' for '{batch[0][3]}': {rv}")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('database_config_file')
     parser.add_argument('-d', '--drop', action='store_true')
     parser.add_argument('-c', '--create', action='store_true')
+    parser.add_argument('--migrate', action='store_true',
+                        help="add the columns, tables and indexes that an existing table "
+                             "lacks, without blocking writes while indexes are built")
+    parser.add_argument('--backfill-resources', action='store_true',
+                        help="populate the resources table from existing HARs")
+    parser.add_argument('--rebuild-summary', nargs='*', metavar='EXPERIMENT',
+                        help="rebuild the summary table from existing HARs, "
+                             "optionally only for some experiments")
+    parser.add_argument('--migrate-archive', action='store_true',
+                        help="move HARs from the table into the configured archive")
+    parser.add_argument('--archive-report', action='store_true',
+                        help="report the compression ratio and read time of the archive")
+    parser.add_argument('--list-partitions', action='store_true')
+    parser.add_argument('--attach-partition', nargs=2, metavar=('TABLE', 'KEY'),
+                        help="attach a table as the partition for an experiment UUID "
+                             "or a month (YYYY-MM)")
+    parser.add_argument('--detach-partition', metavar='TABLE')
+    parser.add_argument('--archive-partition', nargs=2, metavar=('TABLE', 'DIRECTORY'),
+                        help="dump a partition into a directory and drop it")
+    parser.add_argument('--queue-status', nargs='?', const='', metavar='EXPERIMENT',
+                        help="count the tasks in the work queue by state")
     args = parser.parse_args()
 
-    database = Database.init_from_config_file(args.database_config_file)
+    database = Database.init_from_config_file(args.database_config_file,
+                                              check_schema=not (args.drop or args.migrate))
+    if (args.migrate_archive or args.archive_report) and not database.archive:
+        parser.error(f"No 'archive' directory is set in '{args.database_config_file}'")
 
     if args.drop:
         database.drop()
@@ -240,5 +1619,41 @@ def main():
     if args.create:
         database.create()
 
+    if args.migrate and database.migrate():
+        sys.exit(1)
+
+    if args.backfill_resources:
+        database.backfill_resources()
+
+    if args.rebuild_summary is not None:
+        database.rebuild_summary(args.rebuild_summary)
+
+    if args.migrate_archive:
+        database.migrate_to_archive()
+
+    if args.archive_report:
+        report = database.archive_report()
+        if isinstance(report, Exception):
+            sys.exit(f"Error getting the archive report: {report}")
+        for key, value in report.items():
+            print(f"{key}: {value}")
+
+    if args.list_partitions:
+        for partition in database.partitions():
+            print(f"{partition['name']}: {partition['bounds']}")
+
+    if args.attach_partition:
+        database.attach_partition(*args.attach_partition)
+
+    if args.detach_partition:
+        database.detach_partition(args.detach_partition)
+
+    if args.archive_partition:
+        database.archive_partition(*args.archive_partition)
+
+    if args.queue_status is not None:
+        for state, tasks in database.queue_status(args.queue_status or None).items():
+            print(f"{state}: {tasks}")
+
 if __name__ == "__main__":
     main()
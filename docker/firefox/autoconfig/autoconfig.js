@@ -0,0 +1,3 @@
+pref("general.config.filename", "privacy-extensions.cfg");
+pref("general.config.obscure_value", 0);
+pref("general.config.sandbox_enabled", false);
@@ -1,72 +1,152 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import collections
-import csv
-import io
+import datetime
+import logging
 import os
-import signal
 import subprocess
 import threading
+import time
 
+log = logging.getLogger('perfevents')
 
-class PerfEventsCSVDialect(csv.Dialect):
-    delimiter = ' '
-    lineterminator = '\n'
-    quoting = csv.QUOTE_NONE
-    skipinitialspace = True
+EVENTS = ('cpu-clock', 'cpu-migrations', 'context-switches', 'page-faults', 'task-clock')
 
+# perf stat reports the clocks in milliseconds, we keep the nanoseconds that
+# perf stat record reported before
+_NANOSECONDS = {'msec': 1000000}
 
-class PerfEvents(threading.Thread):
-    def __init__(self, timeout):
+
+def _value(value, unit):
+    try:
+        return int(round(float(value) * _NANOSECONDS.get(unit, 1)))
+    except ValueError:
+        # <not counted> or <not supported>
+        return None
+
+
+def cpu_list():
+    # The CPUs that the container is pinned to, only visits on them count
+    return ",".join(str(cpu) for cpu in sorted(os.sched_getaffinity(0)))
+
+
+def parse(output):
+    # Every line of `perf stat -x,` is the value, its unit, the event, the
+    # running time and the percentage of time it ran for, and maybe more
+    perf = {}
+    for line in output.decode('utf-8', errors='replace').splitlines():
+        fields = line.split(",")
+        if len(fields) < 3 or fields[2] not in EVENTS:
+            continue
+        value, unit, event = fields[:3]
+        perf[event] = _value(value, unit)
+    return perf
+
+
+def parse_intervals(output):
+    # With -I, every line starts with the seconds since counting started, at
+    # the end of the interval. Returns the counts of every interval, in order.
+    intervals = {}
+    for line in output.decode('utf-8', errors='replace').splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 4 or fields[3] not in EVENTS:
+            continue
+        timestamp, value, unit, event = fields[:4]
+        intervals.setdefault(float(timestamp), {})[event] = _value(value, unit)
+    return sorted(intervals.items())
+
+
+def _har_time(value):
+    # HARs use ISO 8601 with a Z, which fromisoformat() does not accept
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def align(samples, har):
+    # Makes the times of the samples relative to the start of the page, like
+    # the page timings of the HAR, so negative times are before navigation
+    try:
+        page_start = _har_time(har['pages'][0]['startedDateTime'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return samples
+    offset = (page_start - samples['start']) * 1000
+    samples['time'] = [round(t - offset, 1) for t in samples['time']]
+    samples['aligned'] = True
+    return samples
+
+
+# Counts events on the CPUs of the container with `perf stat` in counting
+# mode, so that workers pinned to other CPUs do not add to the counts. The
+# counters are enabled when perf executes its workload, a shell that says when
+# it runs and then waits for us to close its stdin, so they cover exactly the
+# time between start() and stop(). The counts are read from perf's stderr, nothing
+# is written to disk. With an interval in milliseconds, a second perf also
+# reports the counts of every interval, which are kept in `samples`. It does
+# not report the last, partial interval, so the totals are always those of the
+# first perf.
+class PerfEvents:
+    def __init__(self, timeout, interval=None):
         self._timeout = timeout
-        threading.Thread.__init__(self)
+        self._interval = interval
+        self.process = None
+        self._sampler = None
+        self.started = None
+        self.samples = None
+
+    def _spawn(self, interval=None):
+        cmd = ["perf_4.19", "stat", "-x", ",", "-a", "-C", cpu_list(),
+               "-e", ",".join(EVENTS),
+               *(["-I", str(interval)] if interval else []),
+               "--", "timeout", f"{self._timeout + 1}", "sh", "-c", "echo; read line"]
+        process = subprocess.Popen(cmd,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        # perf writes the intervals as it goes, so they are read while it runs
+        # instead of filling up the pipe
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.extend(process.stderr), daemon=True)
+        reader.start()
+        if not process.stdout.readline():
+            log.error("Error starting perf")
+        return process, reader, stderr
 
-    def run(self):
+    @staticmethod
+    def _finish(process, reader, stderr):
         try:
-            cmd = ["perf_4.19", "stat", "record",
-                   "-e", "cpu-clock",
-                   "-e", "cpu-migrations",
-                   "-e", "context-switches",
-                   "-e", "page-faults",
-                   "-e", "task-clock",
-                   "-a", "--", "sleep", f"{self._timeout + 1}"]
-            self.process = subprocess.Popen(cmd,
-                                            stdout=subprocess.DEVNULL,
-                                            stderr=subprocess.DEVNULL)
-            self.process.wait()
-        except subprocess.CalledProcessError as e:
-            log.error(f"Error collecting performance events: {e}")
+            process.stdin.write(b"\n")
+            process.stdin.close()
+        except BrokenPipeError:
+            # The workload timed out already
+            pass
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        reader.join()
+        return b"".join(stderr)
+
+    def start(self):
+        # The samples are timed from when the second perf started counting
+        if self._interval:
+            self._sampler = self._spawn(self._interval)
+        self.started = time.time()
+        self.process = self._spawn()
 
     def stop(self):
-        try:
-            # Grep process id of sleep
-            cmd = ["pgrep", "-P", f"{self.process.pid}"]
-            run = subprocess.run(cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.DEVNULL)
-            pid = int(run.stdout.strip().decode('utf-8'))
-            if pid:
-                os.kill(pid, signal.SIGTERM)
-                os.kill(pid, signal.SIGKILL)
-        except subprocess.CalledProcessError as e:
-            log.error(f"Error stopping performance event sleep: {e}")
-
-        self.process.wait()
-        return self.parse()
-
-    def parse(self):
-        # Parse performance data
-        cmd = ["perf_4.19", "script"]
-        run = subprocess.run(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.DEVNULL)
-        csv_dict = csv.DictReader(io.StringIO(run.stdout.decode('utf-8')),
-                                dialect=PerfEventsCSVDialect)
-
-        # Transpose and merge results
-        perf = collections.defaultdict(int)
-        for row in csv_dict:
-            perf[row['EVENT']] += int(row['VAL'])
+        if self.process is None:
+            return {}
+
+        perf = parse(self._finish(*self.process))
+        self.process = None
+        if self._sampler is None:
+            return perf
 
+        intervals = parse_intervals(self._finish(*self._sampler))
+        self._sampler = None
+        self.samples = {'interval': self._interval,
+                        'start': self.started,
+                        'time': [round(timestamp * 1000, 1) for timestamp, _ in intervals]}
+        for event in EVENTS:
+            self.samples[event] = [counts.get(event) for _, counts in intervals]
         return perf
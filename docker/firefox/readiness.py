@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import http.server
+import threading
+import time
+import uuid
+
+from selenium.common.exceptions import TimeoutException
+
+# A request that every blocker ships a filter for (EasyList filters the path,
+# Disconnect the domain), it is only blocked once the filter lists of the
+# extension have been loaded and compiled. The browser
+# resolves the host to the loopback address and does not send it through the
+# proxy, so that probing neither reaches an ad server nor is recorded or
+# missed by a replay. No HTTPS Everywhere rule upgrades the host.
+PROBE_HOST = "probe.adnxs.com"
+PROBE_PATH = "/pagead/ads"
+
+BLOCKING_EXTENSIONS = ("adblock_plus",
+                       "disconnect",
+                       "ghostery_privacy_ad_blocker",
+                       "ublock_origin")
+
+# Fetches the probe, a fetch is rejected immediately if an extension blocks it
+PROBE_SCRIPT = """
+    var done = arguments[arguments.length - 1];
+    var options = {mode: 'no-cors', cache: 'no-store', credentials: 'omit'};
+    fetch(arguments[0], options).then(function() { done(true); },
+                                      function() { done(false); });
+"""
+
+# Evaluated in the privileged chrome context, returns the IDs of the add-ons
+# whose background page has been loaded (or that do not have one)
+BACKGROUND_SCRIPT = """
+    return arguments[0].filter(function(id) {
+        var policy = WebExtensionPolicy.getByID(id);
+        if (!policy || !policy.active || !policy.extension) {
+            return false;
+        }
+        var extension = policy.extension;
+        if (!extension.manifest.background) {
+            return true;
+        }
+        return Array.from(extension.views).some(function(view) {
+            return view.viewType == "background";
+        });
+    });
+"""
+
+
+def background_pages(driver, ids):
+    with driver.context(driver.CONTEXT_CHROME):
+        return set(driver.execute_script(BACKGROUND_SCRIPT, list(ids)))
+
+
+class _ProbeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.received.add(self.path)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def probe_server():
+    # Answers the probe on the loopback address, yields its URL
+    server = http.server.HTTPServer(("127.0.0.1", 0), _ProbeHandler)
+    server.received = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, f"http://{PROBE_HOST}:{server.server_port}{PROBE_PATH}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def probe_blocked(driver, server, url, timeout):
+    # Whether the probe was blocked, that is it failed without reaching the
+    # server
+    query = uuid.uuid4().hex
+    driver.set_script_timeout(timeout)
+    try:
+        succeeded = driver.execute_async_script(PROBE_SCRIPT, f"{url}?{query}")
+    except TimeoutException:
+        return False
+    return not succeeded and f"{PROBE_PATH}?{query}" not in server.received
+
+
+def wait_until_ready(driver, extensions, ceiling, interval=0.1):
+    # `extensions` maps extension names to their add-on IDs. We wait until the
+    # background page of every extension is up and, for blockers, until a
+    # request to the probe is actually blocked.
+    started = time.monotonic()
+    ready = {name: None for name in extensions}
+    blocking = any(name in BLOCKING_EXTENSIONS for name in extensions)
+    blocked = None
+
+    with probe_server() as (server, url):
+        while time.monotonic() - started < ceiling:
+            elapsed = time.monotonic() - started
+            loaded = background_pages(driver, extensions.values())
+            for name, addon_id in extensions.items():
+                if ready[name] is None and addon_id in loaded:
+                    ready[name] = elapsed
+
+            if blocking and blocked is None and all(v is not None for v in ready.values()):
+                # The probe must not overrun the ceiling
+                remaining = max(ceiling - (time.monotonic() - started), interval)
+                probed = probe_blocked(driver, server, url, remaining)
+                if probed:
+                    blocked = time.monotonic() - started
+
+            if all(v is not None for v in ready.values()) and (not blocking or blocked is not None):
+                break
+            time.sleep(interval)
+
+    elapsed = time.monotonic() - started
+    return {'elapsed': elapsed,
+            'ceiling': ceiling,
+            'timed_out': elapsed >= ceiling,
+            'extensions': ready,
+            'blocked': blocked}
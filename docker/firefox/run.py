@@ -2,86 +2,358 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
 import json
+import os
 import pathlib
+import shutil
+import socket
 import subprocess
 import sys
+import tempfile
 import time
+import traceback
+import zipfile
 
-from datetime import datetime
-
+import completion
 import perfevents
+import readiness
+import timeline
 
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 
+HAR_SOCKET = "/home/seluser/measure/har.sock"
 
-def main():
-    # Parse the command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument('website')
-    parser.add_argument('--timeout', type=int, default=30)
-    parser.add_argument('--extensions')
-    parser.add_argument('--extensions-wait', type=int, default=1)
-    args = parser.parse_args()
+# Our extension for getting HARs, by whether the visit waits for the load
+# event. Those visits get the signed release, the completion policy needs the
+# version built from our source, which exports when it is told to.
+HAR_EXTENSIONS = {True: "/home/seluser/measure/harexporttrigger-0.6.2-fx.xpi",
+                  False: "/home/seluser/measure/harexporttrigger.xpi"}
+
+# The profiles baked at build time, visits start from copies on a tmpfs
+PROFILES = "/home/seluser/profiles"
+PROFILE_TMPFS = "/tmp/profiles"
+
+# How long the extensions get to store what they compiled once they are ready
+BAKE_SETTLE = 10
+
+# Turn the automatic filter list updates of the blockers off through their
+# own settings, so that the lists stay as they were baked, or date the last
+# update in 2100. Every script runs in a page of its add-on when the profile is
+# baked, in a sandbox that sees the extension APIs on the window of the page.
+# uBlock Origin is turned off by its managed settings in managed-storage/
+# instead, and the update requests of Privacy Badger, which has no setting for
+# it, are cancelled by autoconfig/.
+FREEZE_LIST_UPDATES = {
+    'adblock_plus': ("options.html", """
+        var done = arguments[arguments.length - 1];
+        var chrome = (window.wrappedJSObject || window).chrome;
+        chrome.storage.local.get("pref:notificationdata", function(items) {
+            var notifications = items["pref:notificationdata"] || {};
+            notifications.softExpiration = notifications.hardExpiration = 4102444800000;
+            chrome.storage.local.set({"pref:subscriptions_autoupdate": false,
+                                      "pref:notificationdata": notifications}, done);
+        });
+    """),
+    'disconnect': ("markup/popup.html", """
+        localStorage.lastUpdateTime = 4102444800000;
+        arguments[arguments.length - 1]();
+    """),
+    'https_everywhere': ("pages/options/index.html", """
+        var done = arguments[arguments.length - 1];
+        var chrome = (window.wrappedJSObject || window).chrome;
+        chrome.storage.sync.set({autoUpdateRulesets: false}, function() {
+            chrome.storage.local.set({autoUpdateRulesets: false}, done);
+        });
+    """)}
+
+
+def listen_for_har():
+    # har_catcher.py connects to this socket and streams the HAR to us
+    if os.path.exists(HAR_SOCKET):
+        os.unlink(HAR_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(HAR_SOCKET)
+    server.listen(1)
+    return server
+
+
+def receive_har(server, deadline, policy=None, driver=None, interval=0.1):
+    # Wake up as soon as har_catcher.py has sent the last byte and closed the
+    # connection, or give up at the deadline. Until har_catcher.py connects,
+    # the completion policy may force the export.
+    chunks = []
+    polling = policy is not None and not policy.waits_for_load
+    try:
+        while True:
+            remaining = max(deadline - time.monotonic(), 0.001)
+            server.settimeout(min(remaining, interval) if polling else remaining)
+            try:
+                connection, _ = server.accept()
+                break
+            except socket.timeout:
+                if not polling or time.monotonic() >= deadline:
+                    raise
+                policy.poll(driver)
+        with connection:
+            while True:
+                connection.settimeout(max(deadline - time.monotonic(), 0.001))
+                chunk = connection.recv(1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except socket.timeout:
+        return {}
 
+    if not chunks:
+        return {}
+    return json.loads(b"".join(chunks))
+
+
+def profile_path(extensions):
+    return os.path.join(PROFILES, extensions or "none")
+
+
+def addon_version(path):
+    with zipfile.ZipFile(path) as f:
+        return json.loads(f.read("manifest.json").decode('utf-8-sig'))['version']
+
+
+@contextlib.contextmanager
+def copy_profile(extensions):
+    # Every visit gets its own copy of the baked profile of its configuration,
+    # or a fresh temporary profile if there is none
+    baked = profile_path(extensions)
+    if not os.path.isdir(baked):
+        yield None, {'baked': False}
+        return
+
+    with open(f"{baked}.json") as f:
+        metadata = json.load(f)
+    started = time.monotonic()
+    tmp = tempfile.mkdtemp(dir=PROFILE_TMPFS if os.path.isdir(PROFILE_TMPFS) else None)
+    try:
+        profile = os.path.join(tmp, "profile")
+        shutil.copytree(baked, profile, symlinks=True)
+        yield profile, {'baked': True,
+                        'built': metadata['built'],
+                        'copy': time.monotonic() - started,
+                        'addons': metadata['addons']}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def visit(website, extensions, timeout, extensions_wait, proxy=None, perf_interval=None,
+          idle=None, idle_cap=None):
+    # Listen for the HAR before the browser, and with it har_catcher.py, starts
+    with listen_for_har() as har_socket, copy_profile(extensions) as (profile, metadata):
+        document = _visit(har_socket, website, extensions, timeout, extensions_wait, proxy,
+                          perf_interval, idle, idle_cap, profile, metadata.pop('addons', None))
+    document['profile'] = metadata
+    return document
+
+
+def launch(extensions, proxy=None, profile=None, addon_ids=None, wait_for_load=True):
     # Enable devtools in Firefox
     options = Options()
     options.headless = True
     options.add_argument('-devtools')
 
+    # Every launch gets a fresh temporary profile unless it is given one, the
+    # add-ons of a baked profile are installed already
+    if profile:
+        options.add_argument('-profile')
+        options.add_argument(profile)
+
+    # The completion policy decides when the page is done instead
+    if not wait_for_load:
+        options.capabilities['pageLoadStrategy'] = "none"
+
     # Enable the netmonitor toolbox in devtools so we can save HARs
-    profile = webdriver.FirefoxProfile()
-    profile.set_preference('devtools.toolbox.selectedTool', 'netmonitor')
+    options.set_preference('devtools.toolbox.selectedTool', 'netmonitor')
+
+    # The record/replay proxy intercepts TLS with its own certificates
+    if proxy:
+        host, port = proxy.rsplit(":", 1)
+        options.set_preference('network.proxy.type', 1)
+        for scheme in ('http', 'ssl'):
+            options.set_preference(f'network.proxy.{scheme}', host)
+            options.set_preference(f'network.proxy.{scheme}_port', int(port))
+        options.set_preference('network.proxy.no_proxies_on', readiness.PROBE_HOST)
+        options.accept_insecure_certs = True
+
+    # Resolves the probe of the readiness check to the loopback address, where
+    # it is answered
+    options.set_preference('network.dns.localDomains', readiness.PROBE_HOST)
 
     # Launch Firefox and install our extension for getting HARs
     driver = webdriver.Firefox(options=options,
-                               firefox_profile=profile,
                                firefox_binary="/opt/firefox/firefox-bin")
-    driver.install_addon("/home/seluser/measure/harexporttrigger-0.6.2-fx.xpi")
-    driver.set_page_load_timeout(args.timeout)
-
-    # Install other addons
-    extensions_path = pathlib.Path("/home/seluser/measure/extensions")
-    if args.extensions:
-        for extension in args.extensions.split(","):
-            matches = list(extensions_path.glob("{}*.xpi".format(extension)))
-            if matches and len(matches) == 1:
-                driver.install_addon(str(matches[0]))
-
-    # Start perf timer
-    perf = perfevents.PerfEvents(args.timeout)
-
-    # We need to wait for everything to open up properly
-    time.sleep(args.extensions_wait)
-
-    # Make a page load
-    perf.start()
-    started = datetime.now()
-    driver.get(args.website)
-
-    # Once the HAR is on disk in the container, write it to stdout so the host
-    # machine can get it
-    har_file = "/home/seluser/measure/har.json"
-
-    def har_file_ready():
-        return pathlib.Path(har_file + ".ready").exists()
-
-    while (datetime.now() - started).total_seconds() < args.timeout \
-            and not har_file_ready():
-        time.sleep(1)
-
-    # Stop collecting performance data
-    perf_data = perf.stop()
-
-    # Read HAR file
-    har = {}
-    if har_file_ready():
-        with open(har_file, 'r') as f:
-            har = json.load(f)
-    driver.quit()
-
-    json.dump({'har': har, 'perf': perf_data}, sys.stdout)
+    try:
+        # The version built from our source has no signature, so it can only
+        # be installed temporarily. Either version is installed like that on
+        # every launch and not kept in the baked profiles.
+        har_id = driver.install_addon(HAR_EXTENSIONS[wait_for_load], temporary=True)
+        if addon_ids is not None:
+            return driver, {**addon_ids, 'harexporttrigger': har_id}
+        addon_ids = {'harexporttrigger': har_id}
+
+        # Install other addons
+        extensions_path = pathlib.Path("/home/seluser/measure/extensions")
+        if extensions:
+            for extension in extensions.split(","):
+                matches = list(extensions_path.glob("{}*.xpi".format(extension)))
+                if matches and len(matches) == 1:
+                    addon_ids[extension] = driver.install_addon(str(matches[0]))
+    except Exception:
+        driver.quit()
+        raise
+    return driver, addon_ids
+
+
+def _visit(har_socket, website, extensions, timeout, extensions_wait, proxy=None,
+           perf_interval=None, idle=None, idle_cap=None, profile=None, addon_ids=None):
+    policy = completion.CompletionPolicy(idle, idle_cap)
+    driver, addon_ids = launch(extensions, proxy, profile, addon_ids, policy.waits_for_load)
+    try:
+        driver.set_page_load_timeout(timeout)
+
+        # Start perf timer
+        perf = perfevents.PerfEvents(timeout, perf_interval)
+
+        # We need to wait for everything to open up properly, but no longer
+        # than the extensions actually need to initialise
+        ready = readiness.wait_until_ready(driver, addon_ids, extensions_wait)
+
+        # Make a page load
+        perf.start()
+        deadline = time.monotonic() + timeout
+        driver.get(website)
+
+        # Once the browser exported the HAR, har_catcher.py hands it to us so
+        # we can write it to stdout for the host machine
+        har = receive_har(har_socket, deadline, policy, driver)
+
+        # Stop collecting performance data
+        perf_data = perf.stop()
+
+        # The browser's own view of the page load, once perf stopped counting
+        page_timeline = timeline.collect(driver)
+    finally:
+        driver.quit()
+
+    document = {'har': har, 'perf': perf_data, 'ready': ready, 'timeline': page_timeline,
+                'completion': policy.finish(har),
+                'exporter': addon_version(HAR_EXTENSIONS[policy.waits_for_load])}
+    if perf.samples:
+        document['perf_samples'] = perfevents.align(perf.samples, har)
+    return document
+
+
+def freeze_list_updates(driver, addon_ids):
+    driver.set_script_timeout(10)
+    for extension, addon_id in addon_ids.items():
+        if extension in FREEZE_LIST_UPDATES:
+            page, script = FREEZE_LIST_UPDATES[extension]
+            with driver.context(driver.CONTEXT_CHROME):
+                url = driver.execute_script(
+                    "return WebExtensionPolicy.getByID(arguments[0]).getURL(arguments[1]);",
+                    addon_id, page)
+            driver.get(url)
+            driver.execute_async_script(script)
+
+
+def bake(configurations, extensions_wait):
+    # Launches Firefox once for every configuration with a profile of its own,
+    # which is kept with its add-ons once they are ready and the blockers have
+    # compiled their filter lists
+    for extensions in ["", *configurations]:
+        path = profile_path(extensions)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        driver, addon_ids = launch(extensions, profile=path)
+        try:
+            ready = readiness.wait_until_ready(driver, addon_ids, extensions_wait)
+            time.sleep(BAKE_SETTLE)
+            freeze_list_updates(driver, addon_ids)
+        finally:
+            driver.quit()
+
+        if ready['timed_out']:
+            raise RuntimeError(f"Add-ons of '{extensions}' were not ready after "
+                               f"{extensions_wait}s: {ready}")
+        with open(f"{path}.json", 'w') as f:
+            json.dump({'built': time.time(), 'ready': ready, 'addons': addon_ids}, f)
+        print(f"Baked a profile for '{extensions}' in {ready['elapsed']:.1f}s",
+              file=sys.stderr)
+
+
+def serve(args):
+    # Every request is a single line of JSON, every response is a header line
+    # with the status and payload length followed by the payload itself
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            document = visit(request['website'],
+                             request.get('extensions'),
+                             request.get('timeout', args.timeout),
+                             request.get('extensions_wait', args.extensions_wait),
+                             request.get('proxy', args.proxy),
+                             request.get('perf_interval', args.perf_interval),
+                             request.get('idle', args.idle),
+                             request.get('idle_cap', args.idle_cap))
+            status, payload = "ok", json.dumps(document)
+        except Exception:
+            status, payload = "error", traceback.format_exc()
+
+        payload = payload.encode('utf-8')
+        sys.stdout.buffer.write(f"{status} {len(payload)}\n".encode('utf-8'))
+        sys.stdout.buffer.write(payload)
+        sys.stdout.buffer.flush()
+
+
+def main():
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('website', nargs='?')
+    parser.add_argument('--timeout', type=int, default=30)
+    parser.add_argument('--extensions')
+    parser.add_argument('--extensions-wait', type=int, default=15,
+                        help="maximum number of seconds to wait for the extensions to be ready")
+    parser.add_argument('--serve', action='store_true',
+                        help="serve visit requests from stdin until EOF")
+    parser.add_argument('--perf-interval', type=int, metavar='MS',
+                        help="also sample the perf counters every MS milliseconds")
+    parser.add_argument('--idle', type=int, metavar='MS',
+                        help="end the visit once no response finished for MS "
+                             "milliseconds after the load event, instead of right at it")
+    parser.add_argument('--idle-cap', type=int, metavar='MS',
+                        help="end the visit MS milliseconds after the navigation started "
+                             "at the latest, whether the page loaded or not")
+    parser.add_argument('--proxy', metavar='HOST:PORT',
+                        help="send all traffic through this HTTP(S) proxy, whose "
+                             "certificates are trusted")
+    parser.add_argument('--bake', nargs='*', metavar='CONFIGURATION',
+                        help="bake a profile for no extensions and every configuration")
+    parser.add_argument('--bake-wait', type=int, default=300,
+                        help="maximum number of seconds to wait for the add-ons of "
+                             "a baked profile to be ready")
+    args = parser.parse_args()
+
+    if args.bake is not None:
+        bake(args.bake, args.bake_wait)
+    elif args.serve:
+        serve(args)
+    elif args.website:
+        json.dump(visit(args.website, args.extensions, args.timeout,
+                        args.extensions_wait, args.proxy, args.perf_interval,
+                        args.idle, args.idle_cap),
+                  sys.stdout)
+    else:
+        parser.error("a website is required unless --serve or --bake is given")
 
 
 if __name__ == '__main__':
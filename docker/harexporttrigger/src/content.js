@@ -102,9 +102,12 @@ function onTriggerExport(event) {
   * } = event.detail;
   */
 
+  // The export is forced once the measurement decides that the page is done,
+  // so the HAR is sent as it is instead of waiting for onLoad
   port.postMessage({
     actionId: 0,
     action: "getHAR",
+    force: true,
   });
 }
 
@@ -128,15 +131,16 @@ function onRemoveRequestListener(event) {
 
 /**
 * document.addEventListener("HAR.addRequestListener", onAddRequestListener, false);
-* document.addEventListener("HAR.triggerExport", onTriggerExport, false);
 * document.addEventListener("HAR.removeRequestListener", onRemoveRequestListener, false);
 */
 
-
-window.addEventListener("load", function(event) {
-    console.log("content.js: Page load finished");
-    onTriggerExport(event);
-});
+/**
+ * The completion policy of the measurement exports the HAR with this event,
+ * before or after the load event. Unlike the released version, this one does
+ * not export on the load event, and a synthetic load event would run the
+ * page's handlers.
+ */
+document.addEventListener("HAR.triggerExport", onTriggerExport, false);
 
 
 /**
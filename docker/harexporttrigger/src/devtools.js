@@ -63,6 +63,23 @@ port.onDisconnect.addListener(function() {
 var harInterval;
 
 function onGetHAR(message) {
+  clearInterval(harInterval);
+
+  /**
+   * A forced export sends the HAR as it is
+   */
+  if (message.force) {
+    chrome.devtools.network.getHAR(function(harLog) {
+      port.postMessage({
+        tabId: chrome.devtools.inspectedWindow.tabId,
+        har: harLog,
+        action: "getHAR",
+        actionId: message.actionId,
+      });
+    });
+    return;
+  }
+
   /**
    * The HAR might not actually be updated yet, so we check every 500ms
    */
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from mitmproxy import ctx
+
+
+# Delays every response by a fixed latency and by the time its body takes at
+# a given bandwidth. Responses are shaped independently of each other, like on
+# a link that is never saturated.
+class Shaping:
+    def load(self, loader):
+        loader.add_option("latency", int, 0,
+                          "Milliseconds added to every response")
+        loader.add_option("bandwidth", int, 0,
+                          "Kilobits per second of every response body, 0 is unlimited")
+
+    async def response(self, flow):
+        delay = ctx.options.latency / 1000
+        if ctx.options.bandwidth and flow.response.raw_content:
+            delay += len(flow.response.raw_content) * 8 / (ctx.options.bandwidth * 1000)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+addons = [Shaping()]
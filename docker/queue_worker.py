@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import concurrent.futures
+import logging.config
+import os
+import socket
+import threading
+import time
+
+from container import Container, PersistentContainer, reap_orphans
+from database import Database
+from wrapper import remaining_visits, run_domain, worker_slots
+
+
+# Renews the leases of all tasks of a worker until it stops, so that only the
+# tasks of workers that died are requeued
+class Heartbeat(threading.Thread):
+    def __init__(self, database, worker, lease):
+        super().__init__(name='heartbeat', daemon=True)
+        self._database = database
+        self._worker = worker
+        self._lease = lease
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._lease / 3):
+            self._database.renew_leases(self._worker, self._lease)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_task(log, database, container, task):
+    # A task that was requeued skips the configurations that the previous
+    # worker finished, but still starts with the warm-up visit
+    experiment = str(task['experiment'])
+    completed = database.get_completed_visits(experiment, task['domain'])
+    if isinstance(completed, Exception):
+        raise completed
+
+    plan = {'visits': [{'domain': task['domain'], 'configurations': task['configurations']}]}
+    for visit in remaining_visits(plan, completed):
+        run_domain(log, database, experiment, container, visit['configurations'],
+                   visit['domain'])
+
+
+def work(log, database, container, worker, lease, poll, max_attempts):
+    while True:
+        task = database.claim_task(container.browser, worker, lease, max_attempts)
+        if isinstance(task, Exception):
+            time.sleep(poll)
+            continue
+
+        if task is None:
+            # Tasks that are running elsewhere may still be requeued
+            status = database.queue_status(browser=container.browser)
+            if isinstance(status, Exception) or status.get('running'):
+                time.sleep(poll)
+                continue
+            return
+
+        log.info(f"Claimed task {task['task_id']} for '{task['domain']}'")
+        try:
+            run_task(log, database, container, task)
+        except Exception as e:
+            log.error(f"Error in task {task['task_id']} for '{task['domain']}': {e}")
+            database.release_task(task['task_id'], worker, max_attempts)
+            continue
+        database.complete_task(task['task_id'], worker)
+
+
+def run_node(log, database, containers, worker, lease=120, poll=10, max_attempts=3):
+    # Every container claims tasks on its own thread, the leases of all of
+    # them are renewed by a single heartbeat
+    heartbeat = Heartbeat(database, worker, lease)
+    heartbeat.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(containers)) as executor:
+            futures = [executor.submit(work, log, database, container, worker, lease, poll,
+                                       max_attempts)
+                       for container in containers]
+            for future in futures:
+                future.result()
+    finally:
+        heartbeat.stop()
+        for container in containers:
+            container.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', default="measurement.log")
+    parser.add_argument('database_config_file')
+    parser.add_argument('browser')
+    parser.add_argument('--name', default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="the name of this worker in the work queue")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cpus-per-worker', type=int)
+    parser.add_argument('--memory-per-worker')
+    parser.add_argument('--persistent', action='store_true',
+                        help="serve all visits of a worker from one long-lived container")
+    parser.add_argument('--lease', type=float, default=120,
+                        help="seconds after which the tasks of a worker that stopped "
+                             "sending heartbeats are requeued")
+    parser.add_argument('--poll', type=float, default=10,
+                        help="seconds to wait when there are no tasks to claim")
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--visit-budget', type=float, default=120,
+                        help="seconds after which a visit is killed along with its "
+                             "container, 0 for no limit")
+    parser.add_argument('--reap-unlabelled', action='store_true',
+                        help="also remove containers that were started without an owner "
+                             "label, by an older version")
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log, level=logging.DEBUG)
+    log = logging.getLogger('queue_worker')
+
+    if args.browser not in ('firefox', 'chrome'):
+        raise ValueError(f"Browser must be 'firefox' or 'chrome', not '{args.browser}'")
+
+    database = Database.init_from_config_file(args.database_config_file)
+
+    slots = None
+    if args.workers > 1:
+        slots = worker_slots(args.workers, args.cpus_per_worker, args.memory_per_worker)
+    container_class = PersistentContainer if args.persistent else Container
+    containers = [container_class(args.browser, slot, budget=args.visit_budget or None)
+                  for slot in slots or [None]]
+    reap_orphans(args.reap_unlabelled)
+
+    log.info(f"Starting worker '{args.name}'")
+    start_time = time.time()
+    try:
+        run_node(log, database, containers, args.name, args.lease, args.poll,
+                 args.max_attempts)
+    finally:
+        database.close()
+    log.info(f"Elapsed time: {time.time() - start_time} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import logging
+import os
+import re
+import subprocess
+import time
+import uuid
+
+from container import Container, labels
+from resolver import container_address, create_network
+
+log = logging.getLogger('replay')
+
+RECORD_NETWORK = "privacy-extensions-record"
+RECORD_SUBNET = "172.30.78.0/24"
+# The network that replays happen on has no route to the outside world
+REPLAY_NETWORK = "privacy-extensions-replay"
+REPLAY_SUBNET = "172.30.79.0/24"
+
+PORT = 8080
+
+# Proxies get the addresses after those of the browser containers
+_PROXY_OFFSET = 100
+
+
+def create_networks(record=True):
+    if record:
+        create_network(RECORD_SUBNET, RECORD_NETWORK)
+    create_network(REPLAY_SUBNET, REPLAY_NETWORK, internal=True)
+
+
+# Records the traffic of one visit to a domain without extensions through
+# mitmproxy into an archive, and then serves every configuration of that
+# domain from the archive only, with optional latency and bandwidth shaping,
+# so that extensions are compared on identical content. Every worker has its
+# own proxy.
+class ReplayProxy:
+    def __init__(self, archive, index, latency=0, bandwidth=0, record=True):
+        self._archive = os.path.abspath(archive)
+        self._index = index
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._record = record
+        self._name = None
+        os.makedirs(self._archive, exist_ok=True)
+
+    def _address(self, subnet):
+        return container_address(subnet, _PROXY_OFFSET + self._index)
+
+    @property
+    def address(self):
+        # Where the browser containers on the replay network find the proxy
+        return f"{self._address(REPLAY_SUBNET)}:{PORT}"
+
+    def docker_args(self):
+        return ["--network", REPLAY_NETWORK,
+                "--ip", container_address(REPLAY_SUBNET, self._index)]
+
+    def recorder(self, browser, docker_args=None, budget=None):
+        return Container(browser,
+                         (docker_args or []) + [
+                             "--network", RECORD_NETWORK,
+                             "--ip", container_address(RECORD_SUBNET, self._index)],
+                         run_args=["--proxy", f"{self._address(RECORD_SUBNET)}:{PORT}"],
+                         budget=budget)
+
+    @staticmethod
+    def _filename(domain):
+        return re.sub(r"[^A-Za-z0-9.-]", "_", domain) + ".flows"
+
+    def archived(self, domain):
+        return os.path.exists(os.path.join(self._archive, self._filename(domain)))
+
+    def _start(self, network, subnet, *args):
+        self._name = f"privacy-extensions-proxy-{uuid.uuid4().hex[:12]}"
+        subprocess.run(["docker", "run", "-d", "--rm", "--name", self._name, *labels(),
+                        "--network", network, "--ip", self._address(subnet),
+                        "-v", f"{self._archive}:/archive",
+                        "privacy-extensions-proxy",
+                        "--set", "connection_strategy=lazy",
+                        *args],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            logs = subprocess.run(["docker", "logs", self._name],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if b"listening at" in logs.stdout:
+                return
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"Proxy '{self._name}' did not start")
+
+    def stop(self):
+        if self._name is None:
+            return
+        subprocess.run(["docker", "stop", "-t", "10", self._name],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._name = None
+
+    def record(self, domain, recorder):
+        # Returns whether there is an archive to replay the domain from,
+        # domains are only recorded once so that every experiment that
+        # replays them gets the same content
+        if self.archived(domain) or not self._record:
+            return self.archived(domain)
+
+        filename = self._filename(domain)
+        partial = os.path.join(self._archive, f"{filename}.partial")
+        self._start(RECORD_NETWORK, RECORD_SUBNET, "-w", f"/archive/{filename}.partial")
+        try:
+            _, stderr = recorder.visit("", f"http://{domain}")
+        except Exception as e:
+            log.error(f"Error recording '{domain}': {e}")
+            return False
+        finally:
+            # The proxy writes the last flows when it is stopped
+            self.stop()
+
+        if not os.path.exists(partial) or not os.path.getsize(partial):
+            log.error(f"Nothing was recorded for '{domain}': "
+                      f"{stderr.decode('utf-8', errors='replace')[-200:]}")
+            return False
+        os.replace(partial, os.path.join(self._archive, filename))
+        log.info(f"Recorded '{domain}'")
+        return True
+
+    @contextlib.contextmanager
+    def replaying(self, domain):
+        # Requests that are not in the archive are answered with a 404
+        # instead of going out to the network
+        self._start(REPLAY_NETWORK, REPLAY_SUBNET,
+                    "--server-replay", f"/archive/{self._filename(domain)}",
+                    "--set", "server_replay_reuse=true",
+                    "--set", "server_replay_extra=404",
+                    "--set", f"latency={self._latency}",
+                    "--set", f"bandwidth={self._bandwidth}")
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def metadata(self, domain):
+        return {'archive': self._filename(domain),
+                'latency': self._latency,
+                'bandwidth': self._bandwidth}
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import ipaddress
+import logging
+import random
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+
+log = logging.getLogger('resolver')
+
+NETWORK = "privacy-extensions"
+
+# Query types that are prefetched for every name
+PREFETCH_TYPES = (1, 28)  # A, AAAA
+
+# How long answers without records to take a TTL from are cached for
+NEGATIVE_TTL = 60
+
+_OPT = 41
+
+
+def upstream_nameserver(path="/etc/resolv.conf"):
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except OSError:
+        pass
+    return "8.8.8.8"
+
+
+def _skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def _question(data):
+    # The name, type and class of the first question, names are not case
+    # sensitive and browsers may randomise their case
+    offset = 12
+    labels = []
+    while data[offset]:
+        length = data[offset]
+        labels.append(data[offset + 1:offset + 1 + length].lower())
+        offset += 1 + length
+    qtype, qclass = struct.unpack("!HH", data[offset + 1:offset + 5])
+    return b".".join(labels), qtype, qclass
+
+
+def _ttl_offsets(data):
+    # The offsets of the TTLs of all records except the EDNS pseudo-record
+    qdcount, ancount, nscount, arcount = struct.unpack("!4H", data[4:12])
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = _skip_name(data, offset)
+        rtype, _, _, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+        if rtype != _OPT:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+    return offsets
+
+
+def _query(name, qtype):
+    labels = name.rstrip(".").encode('idna').split(b".")
+    return (struct.pack("!6H", random.getrandbits(16), 0x0100, 1, 0, 0, 0)
+            + b"".join(bytes([len(label)]) + label for label in labels)
+            + b"\0" + struct.pack("!HH", qtype, 1))
+
+
+def _receive(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _receive_message(sock):
+    # Over TCP, every message is prefixed with its length
+    length = _receive(sock, 2)
+    if length is None:
+        return None
+    return _receive(sock, struct.unpack("!H", length)[0])
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        response = self.server.resolver.resolve(data, self.client_address[0])
+        if response:
+            sock.sendto(response, self.client_address)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    # Connections of a previous run may still be in TIME_WAIT
+    allow_reuse_address = True
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection may carry several queries, one after the other
+        self.request.settimeout(self.server.resolver.timeout)
+        try:
+            while True:
+                query = _receive_message(self.request)
+                if query is None:
+                    return
+                response = self.server.resolver.resolve_tcp(query, self.client_address[0])
+                if response is None:
+                    return
+                self.request.sendall(struct.pack("!H", len(response)) + response)
+        except OSError:
+            return
+
+
+# A caching DNS forwarder that the measurement containers use instead of the
+# upstream resolver. Answers are cached for as long as their TTLs allow, and
+# every name of a domain can be prefetched before it is visited, so that the
+# warm-up visit without extensions is no longer needed. Clients retry answers
+# that were truncated over UDP over TCP, those are forwarded without caching.
+class CachingResolver:
+    def __init__(self, address, upstream=None, port=53, timeout=5.0, known_hosts=None):
+        self.address = address
+        self.timeout = timeout
+        self._port = port
+        self._upstream = (upstream or upstream_nameserver(), 53)
+        # Returns the hosts seen in previous visits to a domain
+        self._known_hosts = known_hosts
+        self._cache = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._servers = []
+
+    def start(self):
+        for server_class, handler in ((socketserver.ThreadingUDPServer, _Handler),
+                                      (_TCPServer, _TCPHandler)):
+            server = server_class((self.address, self._port), handler)
+            server.daemon_threads = True
+            server.resolver = self
+            threading.Thread(target=server.serve_forever, name='resolver',
+                             daemon=True).start()
+            self._servers.append(server)
+        log.info(f"Resolving on {self.address}:{self._port} via {self._upstream[0]}")
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def _forward(self, query):
+        for _ in range(2):
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(self.timeout)
+                try:
+                    sock.sendto(query, self._upstream)
+                    response, _ = sock.recvfrom(65535)
+                except socket.timeout:
+                    continue
+                if response[:2] == query[:2]:
+                    return response
+        return None
+
+    def _forward_tcp(self, query):
+        try:
+            with socket.create_connection(self._upstream, timeout=self.timeout) as sock:
+                sock.sendall(struct.pack("!H", len(query)) + query)
+                return _receive_message(sock)
+        except OSError:
+            return None
+
+    def _count(self, client, hit):
+        stats = self._stats.setdefault(client, {'queries': 0, 'hits': 0, 'misses': 0})
+        stats['queries'] += 1
+        stats['hits' if hit else 'misses'] += 1
+
+    def resolve(self, query, client=None):
+        try:
+            key = _question(query)
+        except (IndexError, struct.error):
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > now:
+                self._count(client, True)
+                return self._answer(query, entry, now)
+            self._count(client, False)
+
+        response = self._forward(query)
+        if response is None:
+            return None
+
+        # Only successful and NXDOMAIN answers that were not truncated are
+        # cached, the rest is passed on as it is
+        flags = struct.unpack("!H", response[2:4])[0]
+        if flags & 0x0200 or flags & 0x000f not in (0, 3):
+            return response
+        try:
+            offsets = _ttl_offsets(response)
+        except (IndexError, struct.error):
+            return response
+        ttls = [struct.unpack("!I", response[o:o + 4])[0] for o in offsets]
+        ttl = min(ttls) if ttls else NEGATIVE_TTL
+        if ttl > 0:
+            with self._lock:
+                self._cache[key] = (now + ttl, now, bytes(response), offsets)
+        return response
+
+    def resolve_tcp(self, query, client=None):
+        with self._lock:
+            self._count(client, False)
+        return self._forward_tcp(query)
+
+    @staticmethod
+    def _answer(query, entry, now):
+        # The cached response with the ID of the query and TTLs that count
+        # down from the time it was cached
+        _, cached, response, offsets = entry
+        response = bytearray(response)
+        response[:2] = query[:2]
+        age = int(now - cached)
+        for offset in offsets:
+            ttl = struct.unpack("!I", response[offset:offset + 4])[0]
+            response[offset:offset + 4] = struct.pack("!I", max(ttl - age, 0))
+        return bytes(response)
+
+    def prefetch(self, names):
+        names = {name for name in names if name}
+        queries = []
+        for name in names:
+            for qtype in PREFETCH_TYPES:
+                try:
+                    queries.append(_query(name, qtype))
+                except (UnicodeError, ValueError):
+                    break
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(self.resolve, queries))
+        return len(names)
+
+    def warm(self, domain):
+        # The names the browser will look up first, and those it looked up
+        # in previous visits to the same domain
+        names = {domain, f"www.{domain}"}
+        if self._known_hosts:
+            hosts = self._known_hosts(domain)
+            if not isinstance(hosts, Exception):
+                names |= set(hosts)
+        started = time.monotonic()
+        count = self.prefetch(names)
+        log.info(f"Prefetched {count} names for '{domain}' in "
+                 f"{time.monotonic() - started:.2f}s")
+
+    def stats(self, client=None):
+        with self._lock:
+            return dict(self._stats.get(client, {'queries': 0, 'hits': 0, 'misses': 0}))
+
+
+def visit_stats(before, after):
+    # The queries of one visit, from snapshots of the stats of its container
+    stats = {key: after[key] - before[key] for key in after}
+    stats['hit_rate'] = stats['hits'] / stats['queries'] if stats['queries'] else None
+    return stats
+
+
+def create_network(subnet, name=NETWORK, internal=False):
+    # A user-defined network, so that every container can be given a fixed
+    # address that its queries can be told apart by. The resolver listens on
+    # its gateway, which is an address of the host. Internal networks have no
+    # route to the outside world.
+    network = ipaddress.ip_network(subnet)
+    gateway = str(next(network.hosts()))
+    exists = subprocess.run(["docker", "network", "inspect", name],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if exists.returncode != 0:
+        subprocess.run(["docker", "network", "create", "--subnet", subnet,
+                        "--gateway", gateway, *(["--internal"] if internal else []), name],
+                       check=True, stdout=subprocess.DEVNULL)
+    return gateway
+
+
+def container_address(subnet, index):
+    # The gateway is the first address, containers get the ones after it
+    return str(list(ipaddress.ip_network(subnet).hosts())[index + 1])
+
+
+def container_args(subnet, index, gateway, name=NETWORK):
+    return ["--network", name,
+            "--ip", container_address(subnet, index),
+            "--dns", gateway]
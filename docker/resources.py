@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import urllib.parse
+
+import tldextract
+
+# Use the snapshot of the public suffix list that ships with tldextract, so
+# that ingestion never goes to the network and is reproducible
+_extract = tldextract.TLDExtract(suffix_list_urls=())
+
+TIMINGS = ('blocked', 'dns', 'connect', 'ssl', 'send', 'wait', 'receive')
+
+COLUMNS = ('har_uuid', 'entry', 'url', 'host', 'registrable_domain', 'mime_type',
+           'status', 'transfer_size', 'body_size', 'time',
+           *(f"{timing}_time" for timing in TIMINGS),
+           'blocked')
+
+
+def _number(value):
+    # HARs use -1 for timings and sizes that do not apply
+    if value is None or value < 0:
+        return None
+    return value
+
+
+def registrable_domain(host):
+    if not host:
+        return None
+    extracted = _extract(host)
+    if extracted.domain and extracted.suffix:
+        return f"{extracted.domain}.{extracted.suffix}"
+    return host
+
+
+def is_blocked(entry):
+    # Chrome reports requests cancelled by an extension with this error,
+    # Firefox with a blocked reason
+    response = entry.get('response', {})
+    return 'ERR_BLOCKED_BY_CLIENT' in (response.get('_error') or '') \
+        or bool(response.get('_blockedReason'))
+
+
+def har_resources(har_uuid, extended_har):
+    # One row per HAR entry, in the order of COLUMNS
+    entries = ((extended_har or {}).get('har') or {}).get('entries') or []
+
+    rows = []
+    for index, entry in enumerate(entries):
+        request = entry.get('request', {})
+        response = entry.get('response', {})
+        content = response.get('content', {})
+        timings = entry.get('timings', {})
+
+        url = request.get('url')
+        try:
+            host = urllib.parse.urlsplit(url).hostname if url else None
+        except ValueError:
+            host = None
+
+        transfer_size = _number(response.get('_transferSize'))
+        if transfer_size is None:
+            headers_size = _number(response.get('headersSize'))
+            body_size = _number(response.get('bodySize'))
+            if headers_size is not None and body_size is not None:
+                transfer_size = headers_size + body_size
+
+        rows.append((har_uuid,
+                     index,
+                     url,
+                     host,
+                     registrable_domain(host),
+                     content.get('mimeType'),
+                     response.get('status'),
+                     transfer_size,
+                     _number(content.get('size')),
+                     _number(entry.get('time')),
+                     *(_number(timings.get(timing)) for timing in TIMINGS),
+                     is_blocked(entry)))
+    return rows
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+
+import ijson
+
+# The response bodies, which we do not keep
+CONTENT_TEXT = "har.entries.item.response.content.text"
+
+
+def _strip_zero_bytes(value):
+    return value.replace("\x00", "") if "\x00" in value else value
+
+
+def sanitise(output):
+    # The container output is parsed incrementally, straight from the bytes,
+    # and the document is built from the parser events in the same pass. The
+    # response bodies are skipped while parsing, so they are never part of the
+    # document, and the extra memory is that of the document we keep.
+    builder = ijson.ObjectBuilder()
+    for prefix, event, value in ijson.parse(io.BytesIO(output), use_float=True):
+        if prefix == CONTENT_TEXT or prefix.startswith(CONTENT_TEXT + "."):
+            continue
+        if event == 'map_key' and f"{prefix}.{value}" == CONTENT_TEXT:
+            continue
+
+        # We are removing zero bytes from the JSON document even though they
+        # are technically correct because we don't care for the places they
+        # can occur and PostgreSQL chokes on them
+        if event in ('map_key', 'string'):
+            value = _strip_zero_bytes(value)
+        builder.event(event, value)
+    return builder.value
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import time
+import uuid
+
+from database import Database
+from queue_worker import run_node
+from wrapper import new_plan
+
+CONFIGURATIONS = ["", "adblock_plus", "ublock_origin", "decentraleyes,privacy_badger,ublock_origin"]
+
+
+# Stands in for a browser container, answers every visit with a small extended
+# HAR after a short delay and logs the order of its visits
+class SimulatedContainer:
+    def __init__(self, browser, visits, delay):
+        self.browser = browser
+        self._id = uuid.uuid4().hex
+        self._visits = visits
+        self._delay = delay
+
+    def visit(self, extensions, website, monitor=None, timeout=None):
+        self._visits.put((self._id, extensions, website))
+        time.sleep(random.uniform(0, self._delay))
+        har = {'har': {'pages': [{'pageTimings': {'onLoad': 100, 'onContentLoad': 50}}],
+                       'entries': []},
+               'perf': {}}
+        return json.dumps(har).encode('utf-8'), b""
+
+    def stop(self):
+        pass
+
+
+def node(config, table, name, containers, lease, delay, visits):
+    logging.basicConfig(level=logging.WARNING)
+    log = logging.getLogger(name)
+    database = Database.init_from_config_file(config, table=table)
+    try:
+        run_node(log, database,
+                 [SimulatedContainer('chrome', visits, delay) for _ in range(containers)],
+                 name, lease, poll=lease / 4)
+    finally:
+        database.close()
+
+
+def wait_for_task(database, table, name, timeout=30):
+    # Returns whether the node holds a task, so that killing it leaves one
+    # behind for the others to requeue
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        database.cursor.execute(f"SELECT count(*) FROM {table}_tasks "
+                                f"WHERE state = 'running' AND worker = %s", (name,))
+        running = database.cursor.fetchone()[0]
+        database.conn.rollback()
+        if running:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def check(database, experiment, plan, visits):
+    # Every visit must be in the database, and every worker must have visited
+    # each domain with the warm-up before its configurations
+    errors = []
+    completed = database.get_completed_visits(experiment)
+    expected = {(extensions, visit['domain'])
+                for visit in plan['visits'] for extensions in visit['configurations']}
+    if completed != expected:
+        errors.append(f"{len(expected - completed)} visits are missing")
+
+    status = database.queue_status(experiment)
+    if set(status) != {'done'}:
+        errors.append(f"Tasks are not done: {status}")
+
+    for name, node_visits in visits.items():
+        previous = {}
+        for container, extensions, website in node_visits:
+            if previous.get(container) != website and extensions != "":
+                errors.append(f"'{name}' visited '{website}' without warming up")
+            previous[container] = website
+    return errors
+
+
+def main():
+    # Runs several worker processes against a scratch table, kills some of
+    # them while they hold a task and checks that the queue recovers
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database_config_file')
+    parser.add_argument('--table', default='queue_simulation')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--containers', type=int, default=2,
+                        help="concurrent visits per node")
+    parser.add_argument('--domains', type=int, default=40)
+    parser.add_argument('--kill', type=int, default=1,
+                        help="number of nodes to kill while they run a task")
+    parser.add_argument('--lease', type=float, default=2.0)
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help="maximum seconds per simulated visit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    database = Database.init_from_config_file(args.database_config_file, table=args.table)
+    database.drop()
+    database.create()
+
+    experiment = str(uuid.uuid1())
+    plan = new_plan(experiment, 'chrome', CONFIGURATIONS,
+                    [f"domain{i}.example" for i in range(args.domains)])
+    database.enqueue(plan)
+
+    started = time.monotonic()
+    queues = {f"node{i}": multiprocessing.Queue() for i in range(args.nodes)}
+    processes = {name: multiprocessing.Process(
+                     target=node, args=(args.database_config_file, args.table, name,
+                                        args.containers, args.lease, args.delay, visits))
+                 for name, visits in queues.items()}
+    for process in processes.values():
+        process.start()
+
+    # Kill nodes in the middle of their first tasks, their leases expire and
+    # the other nodes pick the tasks up again
+    for name in list(processes)[:args.kill]:
+        if not wait_for_task(database, args.table, name):
+            print(f"{name} did not claim a task")
+        processes[name].kill()
+        print(f"Killed {name}")
+
+    visits = {name: [] for name in queues}
+    while any(process.is_alive() for process in processes.values()):
+        for name, visits_queue in queues.items():
+            while not visits_queue.empty():
+                visits[name].append(visits_queue.get())
+        time.sleep(0.1)
+    for name, visits_queue in queues.items():
+        while not visits_queue.empty():
+            visits[name].append(visits_queue.get())
+
+    database.cursor.execute(f"SELECT max(attempts), sum(attempts) FROM {args.table}_tasks")
+    max_attempts, attempts = database.cursor.fetchone()
+    database.conn.rollback()
+    print(f"{args.domains} tasks on {args.nodes} nodes in {time.monotonic() - started:.1f}s, "
+          f"{attempts} attempts, at most {max_attempts} for one task")
+
+    errors = check(database, experiment, plan, visits)
+    if args.kill and max_attempts < 2:
+        errors.append("No task of a killed node was requeued")
+    for error in errors:
+        print(error)
+    database.drop()
+    database.close()
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
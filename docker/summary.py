@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import resources
+
+PERF_EVENTS = ('cpu-clock', 'cpu-migrations', 'context-switches', 'page-faults',
+               'task-clock')
+
+COLUMNS = ('experiment', 'browser', 'extensions', 'domain', 'har_uuid',
+           'resources', 'onload', 'oncontentload', 'transfer_size', 'error',
+           'completion_ms', 'ended_by',
+           *(event.replace('-', '_') for event in PERF_EVENTS))
+
+
+def _timing(value):
+    # HARs use -1 (or null) for page timings that never fired
+    if value is None or value < 0:
+        return None
+    return value
+
+
+def har_summary(experiment, browser, extensions, domain, har_uuid, extended_har,
+                har_error, har_resources=None):
+    # One row per visit, in the order of COLUMNS
+    if har_resources is None:
+        har_resources = resources.har_resources(har_uuid, extended_har)
+    har = (extended_har or {}).get('har') or {}
+    perf = (extended_har or {}).get('perf') or {}
+    entries = har.get('entries') or []
+    pages = har.get('pages') or [{}]
+    page_timings = pages[0].get('pageTimings') or {}
+    completion = (extended_har or {}).get('completion') or {}
+
+    transfer_size = sum(resource[resources.COLUMNS.index('transfer_size')] or 0
+                        for resource in har_resources)
+
+    return (experiment,
+            browser,
+            extensions,
+            domain,
+            har_uuid,
+            len(entries),
+            _timing(page_timings.get('onLoad')),
+            _timing(page_timings.get('onContentLoad')),
+            transfer_size,
+            bool(har_error) or not entries,
+            # When the completion policy forced the HAR export, if it did
+            completion.get('ended_at'),
+            completion.get('ended_by'),
+            *(perf.get(event) for event in PERF_EVENTS))
@@ -2,35 +2,237 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import datetime
 import json
 import logging.config
+import math
+import os
+import queue
 import random
-import re
-import subprocess
+import sys
 import time
 import uuid
 
-from database import Database
+import convergence
+from cgroups import CgroupMonitor
+from configurations import CONFIGURATIONS
+from container import Container, PersistentContainer, VisitTimeout, reap_orphans
+from database import BulkWriter, Database
+from replay import ReplayProxy, create_networks
+from resolver import (CachingResolver, container_address, container_args, create_network,
+                      visit_stats)
+from sanitise import sanitise
 
+# The har_error of visits that were killed for overrunning their budget
+VISIT_TIMEOUT = "visit timeout"
 
-def run(log, database, experiment, browser, configurations, domains):
-    random.shuffle(domains)
-    for domain in domains:
-        # We always visit with the website without any extensions first to
-        # warm up the upstream DNS cache.
-        run_configuration(log, None, experiment, browser, "", domain)
+# The page load timeout of run.py, in seconds. Timeouts that are planned from
+# previous experiments are between the minimum and this.
+DEFAULT_TIMEOUT = 30
+MIN_TIMEOUT = 10
 
-        random.shuffle(configurations)
-        for extensions in configurations:
-            run_configuration(log, database, experiment, browser, extensions, domain)
+# Domains that failed this often in at least this many previous visits are
+# left out of plans
+UNREACHABLE_ERROR_RATE = 0.9
+UNREACHABLE_MIN_VISITS = 3
 
+# The seconds a visit takes besides its page load, for starting the container
+# and the browser and waiting for the extensions
+VISIT_OVERHEAD = 10
 
-def run_configuration(log, database, experiment, browser, extensions, domain):
+
+def unreachable(history):
+    return bool(history) and history['visits'] >= UNREACHABLE_MIN_VISITS \
+        and history['error_rate'] >= UNREACHABLE_ERROR_RATE
+
+
+def visit_timeout(history, default=DEFAULT_TIMEOUT):
+    # Enough time for the slow page loads of a domain, with a margin
+    if not history or history['p90_onload'] is None:
+        return default
+    timeout = math.ceil(history['p90_onload'] / 1000 * 1.5) + 5
+    return min(max(timeout, MIN_TIMEOUT), default)
+
+
+def visit_cost(history, timeout):
+    # The expected seconds of one visit, failed visits usually take their
+    # whole timeout
+    if not history or history['median_onload'] is None:
+        return VISIT_OVERHEAD + timeout
+    load = min(history['median_onload'] / 1000, timeout)
+    return VISIT_OVERHEAD + (1 - history['error_rate']) * load \
+        + history['error_rate'] * timeout
+
+
+def new_plan(experiment, browser, configurations, domains, history=None,
+             longest_first=False):
+    # The order in which domains, and the configurations of every domain, are
+    # visited. It is saved so that an interrupted run resumes in that order.
+    plan = {'experiment': experiment,
+            'browser': browser,
+            'completed': None,
+            'visits': [{'domain': domain,
+                        'configurations': random.sample(configurations, len(configurations))}
+                       for domain in random.sample(domains, len(domains))]}
+    if history is None:
+        return plan
+
+    # With the history of previous experiments by domain, every domain gets a
+    # timeout of its own and those that are consistently unreachable are
+    # skipped. Longest first, the domains that cost the most are visited
+    # first so that a pool of workers finishes at about the same time,
+    # domains of the same cost stay in random order.
+    plan['skipped'] = [visit['domain'] for visit in plan['visits']
+                       if unreachable(history.get(visit['domain']))]
+    visits = []
+    for visit in plan['visits']:
+        domain_history = history.get(visit['domain'])
+        if unreachable(domain_history):
+            continue
+        visit['timeout'] = visit_timeout(domain_history)
+        # The configurations and the warm-up visit
+        visit['cost'] = visit_cost(domain_history, visit['timeout']) \
+            * (len(visit['configurations']) + 1)
+        visits.append(visit)
+    if longest_first:
+        visits.sort(key=lambda visit: visit['cost'], reverse=True)
+    plan['visits'] = visits
+    return plan
+
+
+def load_plan(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_plan(path, plan):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(plan, f)
+    os.replace(tmp, path)
+
+
+def remaining_visits(plan, completed):
+    # `completed` is a set of (extensions, domain) pairs that are in the
+    # database already, domains without any visits left are dropped
+    visits = []
+    for visit in plan['visits']:
+        configurations = [extensions for extensions in visit['configurations']
+                          if (extensions, visit['domain']) not in completed]
+        if configurations:
+            visits.append({**visit, 'configurations': configurations})
+    return visits
+
+
+def run(log, database, experiment, browser, visits, slots=None, persistent=False,
+        resolver=None, subnet=None, proxies=None, run_args=None, budget=None):
+    # Every worker owns one container (and its slot, a pinned CPU set and
+    # memory limit) for a whole domain, so that concurrent visits do not
+    # compete for the same cores and skew each other's perf counters and page
+    # load timings. In replay mode, every worker also owns a proxy.
+    container_class = PersistentContainer if persistent else Container
+    containers = []
+    for index, slot in enumerate(slots or [None]):
+        if resolver:
+            # With a fixed address, the DNS queries of every container can be
+            # told apart by the resolver
+            containers.append(container_class(
+                browser, (slot or []) + container_args(subnet, index, resolver.address),
+                container_address(subnet, index), run_args, budget))
+        elif proxies:
+            containers.append(container_class(
+                browser, (slot or []) + proxies[index].docker_args(),
+                run_args=["--proxy", proxies[index].address] + (run_args or []),
+                budget=budget))
+        else:
+            containers.append(container_class(browser, slot, run_args=run_args,
+                                              budget=budget))
+    free_containers = queue.Queue()
+    for index, container in enumerate(containers):
+        free_containers.put((container, proxies[index] if proxies else None,
+                             slots[index] if slots else None))
+
+    def run_pinned(visit):
+        container, proxy, slot = free_containers.get()
+        try:
+            run_domain(log, database, experiment, container, visit['configurations'],
+                       visit['domain'], resolver, proxy, slot, visit.get('timeout'))
+        finally:
+            free_containers.put((container, proxy, slot))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(containers)) as executor:
+            for _ in executor.map(run_pinned, visits):
+                pass
+    finally:
+        for container in containers:
+            container.stop()
+
+
+def run_domain(log, database, experiment, container, configurations, domain,
+               resolver=None, proxy=None, slot=None, timeout=None):
+    # We visit with the website without any extensions first to warm up the
+    # upstream DNS cache, unless the local resolver can prefetch its names.
+    # In replay mode, that visit records the traffic that is replayed.
+    if proxy:
+        recorder = proxy.recorder(container.browser, slot, container.budget)
+        if not proxy.record(domain, recorder):
+            log.error(f"No recording to replay for '{domain}'")
+            return
+        with proxy.replaying(domain):
+            for extensions in configurations:
+                run_configuration(log, database, experiment, container, extensions,
+                                  domain, proxy=proxy, timeout=timeout)
+        return
+
+    if resolver:
+        resolver.warm(domain)
+    else:
+        run_configuration(log, None, experiment, container, "", domain, timeout=timeout)
+
+    for extensions in configurations:
+        run_configuration(log, database, experiment, container, extensions, domain,
+                          resolver, timeout=timeout)
+
+
+def worker_slots(workers, cpus_per_worker=None, memory=None):
+    cpus = sorted(os.sched_getaffinity(0))
+    if not cpus_per_worker:
+        cpus_per_worker = max(len(cpus) // workers, 1)
+    if workers * cpus_per_worker > len(cpus):
+        raise ValueError(f"Cannot pin {workers} workers with {cpus_per_worker} CPUs "
+                         f"each to {len(cpus)} available CPUs")
+
+    slots = []
+    for worker in range(workers):
+        cpuset = cpus[worker * cpus_per_worker:(worker + 1) * cpus_per_worker]
+        slot = ["--cpuset-cpus", ",".join(str(cpu) for cpu in cpuset)]
+        if memory:
+            slot += ["--memory", memory, "--memory-swap", memory]
+        slots.append(slot)
+    return slots
+
+
+def run_configuration(log, database, experiment, container, extensions, domain,
+                      resolver=None, proxy=None, timeout=None):
+    browser = container.browser
     log.info(f"Collecting extended HAR via {browser} with '{extensions}' for '{domain}'")
     try:
-        extended_har, har_error = get_extended_har(log, browser, extensions, domain)
+        before = resolver.stats(container.address) if resolver else None
+        extended_har, har_error = get_extended_har(log, container, extensions, domain,
+                                                      timeout)
         har_uuid = uuid.uuid1()
 
+        if resolver:
+            dns = visit_stats(before, resolver.stats(container.address))
+            log.info(f"DNS cache hit rate for '{domain}' with '{extensions}': "
+                     f"{dns['hits']} of {dns['queries']} queries")
+            if extended_har:
+                extended_har['dns'] = dns
+        if proxy and extended_har:
+            extended_har['replay'] = proxy.metadata(domain)
+
         if database and not database.insert(experiment, browser, extensions, domain,
                                             har_uuid, extended_har, har_error):
             log.info(f"Saved extended HAR via {browser} with '{extensions}' for '{domain}'")
@@ -38,49 +240,31 @@ def run_configuration(log, database, experiment, browser, extensions, domain):
         log.error(f"Unknown error for domain '{domain}': {e}")
 
 
-def get_extended_har(log, browser, extensions, domain):
+def get_extended_har(log, container, extensions, domain, timeout=None):
+    # The resources the container used are accounted for by its cgroup on the
+    # host, unlike the perf counters, which count everything on the host
+    monitor = CgroupMonitor()
     try:
-        cmd = ["docker", "run", "--rm",
-               "--security-opt", "seccomp=seccomp.json",
-               "--cap-add", "SYS_ADMIN",
-               f"privacy-extensions-{browser}",
-               "--extensions", extensions, f"http://{domain}"]
-        run = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        log.error(f"Error in container for '{domain}': {e.output}")
-        har = None
+        stdout, stderr = container.visit(extensions, f"http://{domain}", monitor, timeout)
+    except VisitTimeout as e:
+        log.error(f"Visit to '{domain}' with '{extensions}' was killed: {e}")
+        return None, f"{VISIT_TIMEOUT}: {e}"
+    except Exception as e:
+        log.error(f"Error in container for '{domain}': {e}")
+        return None, str(e)
+
+    if not stdout or stdout.isspace():
+        log.error(f"Output is empty for domain '{domain}'")
+        return None, stderr.decode('utf-8', errors='replace')
 
     try:
-        har = run.stdout.decode('utf-8')
+        json_har = sanitise(stdout)
+        json_har['cgroup'] = monitor.stats()
         har_error = None
     except Exception as e:
-        log.error(f"Error decoding output for domain {domain}: {e}")
-        har_error = run.stderr.decode('utf-8')
-        har = None
-
-    if not har or har == " ":
-        log.error(f"Output is empty for domain '{domain}'")
-        har = None
-        har_error = run.stderr.decode('utf-8')
+        log.error(f"Error decoding HAR for domain '{domain}': {e}")
+        har_error = str(e)
         json_har = None
-    else:
-        try:
-            json_har = json.loads(har)
-            for entry in json_har['har']['entries']:
-                if 'text' in entry['response']['content']:
-                   del entry['response']['content']['text']
-            # If zero-bytes remain after stripping content, we remove them.
-            # We are removing zero bytes from the JSON file even though they are
-            # technically correct because we don't care for the places they can
-            # occur and PostgreSQL chokes on them.
-            har_reassembled = json.dumps(json_har)
-            if "\\u0000" in har_reassembled:
-                har_stripped = re.sub(r"(\\)+u0000", "", har_reassembled)
-                json_har = json.loads(har_stripped)
-        except Exception as e:
-            log.error(f"Error decoding HAR for domain '{domain}': {e}")
-            har_error = str(e)
-            json_har = None
 
     return json_har, har_error
 
@@ -93,8 +277,71 @@ def main():
     parser.add_argument('domains_list_file')
     parser.add_argument('experiment')
     parser.add_argument('browser')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cpus-per-worker', type=int)
+    parser.add_argument('--memory-per-worker')
+    parser.add_argument('--persistent', action='store_true',
+                        help="serve all visits of a worker from one long-lived container")
+    parser.add_argument('--bulk', action='store_true',
+                        help="write HARs to the database in batches from a background thread")
+    parser.add_argument('--bulk-size', type=int, default=100)
+    parser.add_argument('--bulk-interval', type=float, default=5.0)
+    parser.add_argument('--plan-dir',
+                        help="save the order of visits of every experiment in this "
+                             "directory and resume interrupted experiments from it")
+    parser.add_argument('--dns-cache', action='store_true',
+                        help="resolve through a local caching resolver that prefetches "
+                             "the names of every domain instead of a warm-up visit")
+    parser.add_argument('--dns-upstream',
+                        help="the resolver to forward to, by default the one of the host")
+    parser.add_argument('--dns-subnet', default="172.30.77.0/24",
+                        help="the subnet of the network of the containers")
+    parser.add_argument('--replay', metavar='ARCHIVE',
+                        help="record every domain once into this directory through a "
+                             "proxy and replay it to all configurations without network "
+                             "access")
+    parser.add_argument('--replay-only', action='store_true',
+                        help="only replay domains that were recorded before, so that no "
+                             "network access is needed at all")
+    parser.add_argument('--latency', type=int, default=0,
+                        help="milliseconds added to every replayed response")
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help="kilobits per second of every replayed response")
+    parser.add_argument('--perf-interval', type=int, metavar='MS',
+                        help="also record the perf counters of every MS milliseconds "
+                             "of a visit under 'perf_samples'")
+    parser.add_argument('--visit-budget', type=float, default=120,
+                        help="seconds after which a visit is killed along with its "
+                             "container, 0 for no limit")
+    parser.add_argument('--reap-unlabelled', action='store_true',
+                        help="also remove containers that were started without an owner "
+                             "label, by an older version")
+    parser.add_argument('--idle', type=int, metavar='MS',
+                        help="end every visit once no response finished for MS "
+                             "milliseconds after the load event")
+    parser.add_argument('--idle-cap', type=int, metavar='MS',
+                        help="end every visit MS milliseconds after the navigation "
+                             "started at the latest")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="plan a timeout for every domain from previous experiments, "
+                             "skip domains that are consistently unreachable and, with "
+                             "more than one worker, visit the longest domains first")
+    parser.add_argument('--passes', metavar='FILE',
+                        help="the UUIDs of the previous passes of a series, one per line; "
+                             "only the pairs of domain and configuration that have not "
+                             "converged in them are visited")
+    parser.add_argument('--precision', type=float, default=convergence.PRECISION,
+                        help="the half-width of the confidence intervals that pairs "
+                             "converge at, as a fraction of the baseline mean")
+    parser.add_argument('--min-passes', type=int, default=convergence.MIN_PASSES)
+    parser.add_argument('--enqueue', action='store_true',
+                        help="add the visits to the work queue for queue_worker.py "
+                             "instead of running them")
     args = parser.parse_args()
 
+    if args.replay and args.dns_cache:
+        parser.error("--dns-cache has no effect on replayed visits")
+
     logging.basicConfig(filename=args.log, level=logging.DEBUG)
     log = logging.getLogger('wrapper')
 
@@ -106,27 +353,127 @@ def main():
     with open(args.domains_list_file, 'r') as f:
         domains = [line.strip() for line in f]
 
-    extensions_configurations = [
-        # No extensions
-        "",
-        # Extensions on their own
-        "adblock_plus",
-        "decentraleyes",
-        "disconnect",
-        "ghostery_privacy_ad_blocker",
-        "https_everywhere",
-        "noscript_security_suite",
-        "privacy_badger",
-        "ublock_origin",
-        # Combinations
-        "decentraleyes,privacy_badger,ublock_origin"
-    ]
+    # An experiment that was interrupted is resumed with the plan it was
+    # started with, skipping the visits that are in the database already
+    plan_path = None
+    if args.plan_dir:
+        os.makedirs(args.plan_dir, exist_ok=True)
+        plan_path = os.path.join(args.plan_dir, f"{args.experiment}.json")
+    if plan_path and os.path.exists(plan_path):
+        plan = load_plan(plan_path)
+        if plan['browser'] != args.browser:
+            raise ValueError(f"Experiment '{args.experiment}' was started with "
+                             f"'{plan['browser']}', not '{args.browser}'")
+    else:
+        history = None
+        if args.adaptive:
+            # Failed visits count as taking the whole default timeout, so
+            # that domains which often fail keep it
+            history = database.get_domain_history(args.browser,
+                                                  failed_onload=DEFAULT_TIMEOUT * 1000)
+            if isinstance(history, Exception):
+                raise history
+        plan = new_plan(args.experiment, args.browser, CONFIGURATIONS, domains, history,
+                        longest_first=args.workers > 1 or args.enqueue)
+        if plan.get('skipped'):
+            log.info(f"Skipping {len(plan['skipped'])} domains that were unreachable "
+                     f"in previous experiments")
+        if args.passes:
+            # Pairs that converged in the previous passes are left out
+            passes = convergence.read_passes(args.passes)
+            pending, counts = convergence.pending_pairs(
+                convergence.pass_results(database, passes), domains, CONFIGURATIONS,
+                args.precision, args.min_passes)
+            converged = {(extensions, domain)
+                         for domain in domains for extensions in CONFIGURATIONS} - pending
+            plan['visits'] = remaining_visits(plan, converged)
+            log.info(f"After {len(passes)} passes, {counts['converged']} pairs converged, "
+                     f"{counts['pending']} pending and {counts['failing']} failing")
+        if plan_path:
+            save_plan(plan_path, plan)
+
+    if args.enqueue:
+        rv = database.enqueue(plan)
+        if rv:
+            raise rv
+        log.info(f"Enqueued {len(plan['visits'])} domains of experiment '{args.experiment}'")
+        return
+
+    completed = database.get_completed_visits(args.experiment)
+    if isinstance(completed, Exception):
+        raise completed
+    visits = remaining_visits(plan, completed)
+    total = sum(len(visit['configurations']) for visit in plan['visits'])
+    left = sum(len(visit['configurations']) for visit in visits)
+    if left < total:
+        log.info(f"Resuming experiment '{args.experiment}', {total - left} of {total} "
+                 f"visits are done")
+
+    slots = None
+    if args.workers > 1:
+        slots = worker_slots(args.workers, args.cpus_per_worker, args.memory_per_worker)
+
+    writer = database
+    if args.bulk:
+        writer = BulkWriter(database, args.bulk_size, args.bulk_interval)
+        writer.start()
+
+    resolver = None
+    if args.dns_cache:
+        gateway = create_network(args.dns_subnet)
+        resolver = CachingResolver(gateway, args.dns_upstream,
+                                   known_hosts=database.get_known_hosts)
+        resolver.start()
+
+    proxies = None
+    if args.replay:
+        create_networks(record=not args.replay_only)
+        proxies = [ReplayProxy(args.replay, index, args.latency, args.bandwidth,
+                               record=not args.replay_only)
+                   for index in range(len(slots or [None]))]
+
+    # Containers of runs that crashed would hold on to their CPUs and memory
+    reap_orphans(args.reap_unlabelled)
+
+    run_args = []
+    if args.perf_interval:
+        run_args += ["--perf-interval", str(args.perf_interval)]
+    if args.idle:
+        run_args += ["--idle", str(args.idle)]
+    if args.idle_cap:
+        run_args += ["--idle-cap", str(args.idle_cap)]
 
     log.info("Starting new run")
     start_time = time.time()
-    run(log, database, args.experiment, args.browser, extensions_configurations, domains)
+    try:
+        run(log, writer, args.experiment, args.browser, visits, slots, args.persistent,
+            resolver, args.dns_subnet, proxies, run_args, args.visit_budget or None)
+    finally:
+        if resolver:
+            log.info(f"DNS cache: {resolver.stats(None)} for prefetching")
+            resolver.stop()
+        if args.bulk:
+            writer.close()
+        if database.spilled:
+            log.warning(f"{database.spilled} HARs were spilled, they are replayed "
+                        f"when the database is next opened")
+
+    # Visits that raised are not in the database, the plan is only marked as
+    # completed once every visit is
+    completed = database.get_completed_visits(args.experiment)
+    left = len(remaining_visits(plan, set() if isinstance(completed, Exception) else completed))
+    if not left and plan_path:
+        plan['completed'] = datetime.datetime.utcnow().isoformat()
+        save_plan(plan_path, plan)
+    database.close()
     log.info(f"Elapsed time: {time.time() - start_time} seconds")
 
+    # Exits non-zero so that the run is resumed instead of started over
+    if left:
+        log.warning(f"{left} domains of experiment '{args.experiment}' have visits left")
+        sys.exit(f"{left} domains of experiment '{args.experiment}' have visits left, "
+                 f"run it again to resume it")
+
 
 if __name__ == '__main__':
     main()
@@ -8,22 +8,66 @@ LOGS=$(realpath "${1}")
 DATABASE_CONFIG=$(realpath "${2}")
 DOMAINS_LIST=$(realpath "${3}")
 BROWSER=${4}
+WORKERS=${5:-1}
+MAX_PASSES=${6:-20}
 
 mkdir -p ${LOGS}
 
 # wrapper.py assumes that various files are in the same directory
 pushd "${SELFPATH}/../docker" > /dev/null
 
+# The UUID of the current run is kept until it completes, so that a run that
+# was interrupted by a crash is resumed instead of started over
+CURRENT="${LOGS}/current-run"
+
+# The UUIDs of the completed runs. Every run only visits the pairs of domain
+# and extensions whose difference to the domain without extensions has not
+# converged in the previous runs yet, and the runs stop once all have, or
+# after the maximum number of runs.
+PASSES="${LOGS}/passes"
+touch "${PASSES}"
+
+# convergence.py exits with 0 while another run is needed and with 2 once
+# the runs are done, anything else is an error
 while true; do
-    UUID=$(uuidgen -t)
-    echo "Starting measurement run '${UUID}' at $(date)"
-    pipenv run python3 wrapper.py \
-        ${LOGS}/${UUID}.log \
-        ${DATABASE_CONFIG} \
-        ${DOMAINS_LIST} \
-        ${UUID} \
-        ${BROWSER}
+    if [ ! -f "${CURRENT}" ]; then
+        STATUS=0
+        pipenv run python3 convergence.py ${DATABASE_CONFIG} ${DOMAINS_LIST} ${PASSES} \
+            --max-passes ${MAX_PASSES} || STATUS=$?
+        if [ ${STATUS} -eq 2 ]; then
+            break
+        elif [ ${STATUS} -ne 0 ]; then
+            echo "Checking the convergence of the runs failed with status ${STATUS} at $(date)"
+            exit 1
+        fi
+    fi
+    if [ -f "${CURRENT}" ]; then
+        UUID=$(cat "${CURRENT}")
+        echo "Resuming measurement run '${UUID}' at $(date)"
+    else
+        UUID=$(uuidgen -t)
+        echo "${UUID}" > "${CURRENT}"
+        echo "Starting measurement run '${UUID}' at $(date)"
+    fi
+    # A run with visits left is kept as the current run, so that it is
+    # resumed on restart
+    if ! pipenv run python3 wrapper.py \
+            ${LOGS}/${UUID}.log \
+            ${DATABASE_CONFIG} \
+            ${DOMAINS_LIST} \
+            ${UUID} \
+            ${BROWSER} \
+            --workers ${WORKERS} \
+            --plan-dir ${LOGS}/plans \
+            --passes ${PASSES}; then
+        echo "Measurement run '${UUID}' did not complete at $(date), restart to resume it"
+        exit 1
+    fi
+    echo "${UUID}" >> "${PASSES}"
+    rm "${CURRENT}"
     echo "Completed measurement run '${UUID}' at $(date)"
 done
 
+echo "Finished after $(wc -l < "${PASSES}") measurement runs at $(date)"
+
 popd > /dev/null